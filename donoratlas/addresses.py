@@ -1,9 +1,32 @@
+import json
+import logging
+import multiprocessing
+import os
 import re
-from typing import Optional
+from collections import Counter
+from functools import lru_cache
+from typing import Iterable, Optional, Sequence
 
-from postal.parser import parse_address as postal_parse_address
+import numpy as np
 from pydantic import BaseModel
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
+
+from donoratlas import PACKAGE_DIR, STATE_NAME_TO_ABBREV
+from donoratlas.fuzzy import CUTOFF_EPSILON, wratio
+
+logger = logging.getLogger(__name__)
+
+USPS_ABBREVIATIONS = json.load(
+    open(os.path.join(PACKAGE_DIR, "static", "usps_abbreviations.json"), encoding="utf-8")
+)
+STREET_SUFFIXES: dict[str, str] = USPS_ABBREVIATIONS["suffixes"]
+DIRECTIONALS: dict[str, str] = USPS_ABBREVIATIONS["directionals"]
+UNIT_DESIGNATORS: set[str] = set(USPS_ABBREVIATIONS["unit_designators"])
+
+_STATE_TO_ABBREV = {
+    **{name.casefold(): abbrev for name, abbrev in STATE_NAME_TO_ABBREV.items()},
+    **{abbrev.casefold(): abbrev for abbrev in STATE_NAME_TO_ABBREV.values()},
+}
 
 
 class Address(BaseModel):
@@ -15,13 +38,255 @@ class Address(BaseModel):
     postcode: Optional[str] = None
 
 
+ADDRESS_FIELDS = tuple(Address.model_fields)
+
+
+def postal_parse_address(address: str) -> list[tuple[str, str]]:
+    """
+    Parse an address with libpostal.
+
+    libpostal is only imported (which loads its multi-GB model) the first time this is called, so processes that
+    only see addresses handled by the fast path never pay for it.
+    """
+    from postal.parser import parse_address
+
+    return parse_address(address)
+
+
+def _alternation(words) -> str:
+    return "|".join(re.escape(word) for word in sorted(set(words), key=len, reverse=True))
+
+
+_STREET_SUFFIX_RE = _alternation([*STREET_SUFFIXES, *STREET_SUFFIXES.values()])
+_DIRECTIONAL_RE = _alternation(DIRECTIONALS)
+_STATE_RE = _alternation(_STATE_TO_ABBREV)
+_UNIT_DESIGNATOR_RE = _alternation(UNIT_DESIGNATORS)
+
+# A well-formed US address: "123 Main St Apt 4, Springfield, IL 62701". The road must end in a known street
+# suffix (optionally followed by a directional), a unit must be a whole designator followed by an identifier with
+# a digit (so "Nowhere" or "Lotus" aren't read as units) and the state must be a known state name or code, so
+# anything unusual falls through to libpostal.
+FAST_ADDRESS_RE = re.compile(
+    rf"""
+    ^(?P<house_number>\d+[a-z]?(?:-\d+[a-z]?)?)\s+
+    (?P<road>[a-z0-9][a-z0-9 .'-]*?\s(?:{_STREET_SUFFIX_RE})\.?(?:\s(?:{_DIRECTIONAL_RE})\.?)?)
+    (?:\s*,?\s*(?P<unit>
+        (?:{_UNIT_DESIGNATOR_RE})\b\.?\s*\#?\s*(?=[a-z0-9-]*\d)[a-z0-9-]+
+        |\#\s*[a-z0-9-]+
+    ))?
+    \s*,\s*(?P<city>[a-z][a-z .'-]*?)\s*,?\s+
+    (?P<state>{_STATE_RE})\.?
+    (?:\s*,?\s*(?P<postcode>\d{{5}}(?:-?\d{{4}})?))?
+    (?:\s*,?\s*(?:usa|us|united\sstates))?$
+    """,
+    re.VERBOSE,
+)
+
+# How many addresses were parsed by each path ("fast" or "libpostal"). Repeats served from the parse cache or
+# deduplicated by `parse_addresses` count towards the path that parsed them the first time.
+PARSE_PATH_COUNTS: Counter = Counter()
+
+
+def fast_parse_address(address: str) -> tuple[Address, bool]:
+    """
+    Parse a well-formed US address with a regular expression, without libpostal.
+
+    Parameters
+    ----------
+    address : str
+        The address to parse.
+
+    Returns
+    -------
+    Address
+        The parsed address, with the same (lowercased) values libpostal would return. Empty if not confident.
+    bool
+        Whether the fast path was confident in the parse.
+    """
+    fields = _fast_parse_address_fields(_normalize_address_text(address))
+    if fields is None:
+        return Address(), False
+    return Address(**dict(zip(ADDRESS_FIELDS, fields))), True
+
+
+def _fast_parse_address_fields(normalized_address: str) -> Optional[tuple[Optional[str], ...]]:
+    match = FAST_ADDRESS_RE.match(normalized_address)
+    if match is None:
+        return None
+    return tuple(None if match[field] is None else match[field].strip() for field in ADDRESS_FIELDS)
+
+
+def _parse_address_fields(address: str) -> tuple[tuple[Optional[str], ...], str]:
+    """
+    Parse an address into a tuple of field values, in the order of `ADDRESS_FIELDS`, and the path that parsed it
+    ("fast" or "libpostal").
+
+    The fast path is tried first, and libpostal is only used when it is not confident.
+    """
+    fast_fields = _fast_parse_address_fields(_normalize_address_text(address))
+    if fast_fields is not None:
+        return fast_fields, "fast"
+
+    fields = dict.fromkeys(ADDRESS_FIELDS)
+    for value, field in postal_parse_address(address):
+        if field in fields:
+            fields[field] = value
+    return tuple(fields.values()), "libpostal"
+
+
+def parse_path_report() -> dict[str, float]:
+    """
+    Report how many of the addresses parsed in this process took the fast path and how many needed libpostal.
+
+    Every input is counted, including repeats answered from the parse cache (see `parse_cache_info` for how many
+    those were), so the fractions describe the input rather than the distinct addresses.
+
+    Returns
+    -------
+    dict[str, float]
+        The counts for "fast" and "libpostal", and "fast_fraction", the fraction of inputs that took the fast
+        path.
+    """
+    total = PARSE_PATH_COUNTS["fast"] + PARSE_PATH_COUNTS["libpostal"]
+    return {
+        "fast": PARSE_PATH_COUNTS["fast"],
+        "libpostal": PARSE_PATH_COUNTS["libpostal"],
+        "fast_fraction": PARSE_PATH_COUNTS["fast"] / total if total else 0.0,
+    }
+
+
+def reset_parse_path_report():
+    PARSE_PATH_COUNTS.clear()
+
+
+# The maximum number of distinct (normalized) addresses whose libpostal results are kept in memory
+PARSE_CACHE_SIZE = 100_000
+
+
+def _normalize_address_text(address: str) -> str:
+    return re.sub(r"\s+", " ", address).strip().casefold()
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_address_fields_cached(normalized_address: str) -> tuple[tuple[Optional[str], ...], str]:
+    return _parse_address_fields(normalized_address)
+
+
+def _parse_address_fields_counted(address: str) -> tuple[Optional[str], ...]:
+    fields, path = _parse_address_fields_cached(_normalize_address_text(address))
+    PARSE_PATH_COUNTS[path] += 1
+    return fields
+
+
+def parse_cache_info():
+    """
+    Get the hit/miss statistics of the parsed address cache.
+
+    Returns
+    -------
+    functools._CacheInfo
+        A named tuple of (hits, misses, maxsize, currsize).
+    """
+    return _parse_address_fields_cached.cache_info()
+
+
+def clear_parse_cache():
+    """
+    Empty the parsed address cache and reset its statistics.
+    """
+    _parse_address_fields_cached.cache_clear()
+
+
+class ParsedAddress(Address):
+    """
+    An address together with its original text, parsed once so it can be compared many times.
+
+    Attributes
+    ----------
+    text : str
+        The original address string.
+    """
+
+    text: str
+
+    @classmethod
+    def parse(cls, address: str) -> "ParsedAddress":
+        fields = _parse_address_fields_counted(address)
+        return cls(text=address, **dict(zip(ADDRESS_FIELDS, fields)))
+
+
 def parse_address(address: str) -> Address:
-    ret = Address()
-    parsed_address = postal_parse_address(address)
-    for value, field in parsed_address:
-        if field in Address.model_fields:
-            setattr(ret, field, value)
-    return ret
+    return Address(**dict(zip(ADDRESS_FIELDS, _parse_address_fields_counted(address))))
+
+
+def _parse_address_chunk(addresses: list[str]) -> list[tuple[tuple[Optional[str], ...], str]]:
+    empty = (None,) * len(ADDRESS_FIELDS)
+    parsed = []
+    for address in addresses:
+        try:
+            parsed.append(_parse_address_fields(address))
+        except ImportError:
+            # libpostal isn't installed, which is a problem with the environment rather than with this address
+            raise
+        except Exception:
+            # Only libpostal can fail on an address
+            logger.debug("Failed to parse %r", address, exc_info=True)
+            parsed.append((empty, "libpostal"))
+    return parsed
+
+
+def parse_addresses(
+    addresses: Iterable[str], workers: Optional[int] = None, chunk_size: int = 1_000
+) -> dict[str, list[Optional[str]]]:
+    """
+    Parse many addresses at once.
+
+    Duplicate addresses are only parsed once, and the unique addresses are spread across worker processes which
+    each initialize libpostal once (if any of their addresses need it).
+    Addresses libpostal fails on parse to all-None fields, but if libpostal is needed and not installed, the
+    ImportError is raised.
+
+    Parameters
+    ----------
+    addresses : Iterable[str]
+        The addresses to parse. Missing (non-string or empty) addresses parse to all-None fields.
+    workers : Optional[int]
+        The number of worker processes. Defaults to the number of CPUs. With 1 worker, addresses are parsed in
+        the current process.
+    chunk_size : int
+        The number of unique addresses sent to a worker at a time.
+
+    Returns
+    -------
+    dict[str, list[Optional[str]]]
+        A mapping from each field of `Address` to a list of values, aligned to the input order.
+    """
+    empty = (None,) * len(ADDRESS_FIELDS)
+    unique_to_idx: dict[str, int] = {}
+    inverse: list[int] = []
+    for address in addresses:
+        if not isinstance(address, str) or not address.strip():
+            inverse.append(-1)
+            continue
+        inverse.append(unique_to_idx.setdefault(address, len(unique_to_idx)))
+
+    unique = list(unique_to_idx)
+    chunks = [unique[i : i + chunk_size] for i in range(0, len(unique), chunk_size)]
+
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    parsed = []
+    if workers <= 1:
+        for chunk in chunks:
+            parsed.extend(_parse_address_chunk(chunk))
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            for rows in pool.imap(_parse_address_chunk, chunks):
+                parsed.extend(rows)
+
+    # Count every input, not just the unique addresses, so duplicates weigh in on the path they took
+    PARSE_PATH_COUNTS.update(parsed[idx][1] for idx in inverse if idx != -1)
+    rows = [empty if idx == -1 else parsed[idx][0] for idx in inverse]
+    return {field: [row[i] for row in rows] for i, field in enumerate(ADDRESS_FIELDS)}
 
 
 def format_zip(zip: str) -> str:
@@ -37,68 +302,195 @@ def format_zip(zip: str) -> str:
             return just_numbers
 
 
-def address_similarity(address1: str, address2: str) -> float:
+def _canonical_road(road: str) -> str:
+    words = re.findall(r"[a-z0-9]+", road.casefold())
+    if len(words) > 1:
+        # Directionals only abbreviate at either end ("North Main St", "Main St NW"), never as the street name, so
+        # a leading one needs a name between it and the suffix ("North St" is not "N St")
+        if words[0] in DIRECTIONALS and len(words) > 2:
+            words[0] = DIRECTIONALS[words[0]]
+        if words[-1] in DIRECTIONALS:
+            words[-1] = DIRECTIONALS[words[-1]]
+        # The suffix is the last word, or the one before a trailing directional
+        suffix_idx = (
+            len(words) - 2 if words[-1] in DIRECTIONALS.values() and len(words) > 2 else len(words) - 1
+        )
+        words[suffix_idx] = STREET_SUFFIXES.get(words[suffix_idx], words[suffix_idx])
+    return " ".join(words).upper()
+
+
+def _canonical_unit(unit: str) -> str:
+    words = re.findall(r"[a-z0-9]+", unit.casefold())
+    # Designators glued to the identifier ("Apt4") are dropped the same as separate ones ("Apt 4")
+    identifiers = [
+        re.sub(rf"^(?:{_UNIT_DESIGNATOR_RE})(?=\d)", "", word)
+        for word in words
+        if word not in UNIT_DESIGNATORS
+    ]
+    # A unit with no identifier ("Rear", "Upper") is kept as is
+    return "".join(identifiers or words).upper()
+
+
+def canonical_address_key(address: str | Address) -> Optional[str]:
+    """
+    Build a canonical key for an address, so that variants of the same address can be matched with an exact join.
+
+    Street suffixes and directionals are abbreviated USPS-style, unit designators are dropped ("Apt 4", "#4" and
+    "Unit 4" all become "4"), ZIP codes are cut to 5 digits and states are abbreviated. For example, both
+    "123 Main Street Apt 4, Springfield, IL 62701" and "123 MAIN ST #4, Springfield, Illinois 62701" have the key
+    "123|MAIN ST|4|62701".
+
+    Parameters
+    ----------
+    address : str | Address
+        The address, either raw or already parsed.
+
+    Returns
+    -------
+    Optional[str]
+        The key, or None if the address has no house number or road.
+        The last part of the key is the ZIP5, or the city and state when there is no ZIP code.
+    """
+    if not isinstance(address, Address):
+        address = ParsedAddress.parse(address)
+    return _canonical_address_key(*(getattr(address, field) for field in ADDRESS_FIELDS))
+
+
+def _canonical_address_key(
+    house_number: Optional[str],
+    road: Optional[str],
+    unit: Optional[str],
+    city: Optional[str],
+    state: Optional[str],
+    postcode: Optional[str],
+) -> Optional[str]:
+    if not house_number or not road:
+        return None
+
+    zip5 = format_zip(postcode)[:5] if postcode else ""
+    if len(zip5) == 5:
+        location = zip5
+    else:
+        state = "" if state is None else state.strip().casefold()
+        location = " ".join(re.findall(r"[a-z0-9]+", (city or "").casefold())).upper()
+        location += "|" + _STATE_TO_ABBREV.get(state, state.upper())
+
+    return "|".join(
+        [
+            re.sub(r"[^0-9A-Z/-]", "", house_number.upper()),
+            _canonical_road(road),
+            "" if unit is None else _canonical_unit(unit),
+            location,
+        ]
+    )
+
+
+def canonical_address_keys(addresses: Iterable[str], workers: Optional[int] = None) -> list[Optional[str]]:
+    """
+    Build canonical keys (see `canonical_address_key`) for many addresses at once, using `parse_addresses`.
+
+    Parameters
+    ----------
+    addresses : Iterable[str]
+        The addresses.
+    workers : Optional[int]
+        The number of worker processes used for parsing.
+
+    Returns
+    -------
+    list[Optional[str]]
+        The keys, aligned to the input order.
+    """
+    columns = parse_addresses(addresses, workers=workers)
+    return [_canonical_address_key(*fields) for fields in zip(*(columns[field] for field in ADDRESS_FIELDS))]
+
+
+def _house_number_score(house_number1: Optional[str], house_number2: Optional[str]) -> Optional[float]:
+    if house_number1 is None or house_number2 is None:
+        return None
+    return (fuzz.ratio(house_number1, house_number2) / 100) ** 3 * 2 - 1
+
+
+def _road_score(road1: Optional[str], road2: Optional[str], score_cutoff: float = -1) -> Optional[float]:
+    """
+    Score two roads between -1 and 1. Scores below `score_cutoff` may be returned as -1.
+    """
+    if road1 is None or road2 is None:
+        return None
+    return (wratio(road1, road2, (score_cutoff + 1) / 2 * 100) / 100) * 2 - 1
+
+
+def _city_score(city1: Optional[str], city2: Optional[str], score_cutoff: float = -1) -> Optional[float]:
+    """
+    Score two cities between -1 and 1. Scores below `score_cutoff` may be returned as -1.
+    """
+    if city1 is None or city2 is None:
+        return None
+    return (wratio(city1, city2, (score_cutoff + 1) / 2 * 100) / 100) * 2 - 1
+
+
+def _state_score(state1: Optional[str], state2: Optional[str]) -> Optional[float]:
+    if state1 is None or state2 is None:
+        return None
+    return 1 if state1 == state2 else -1
+
+
+def _zip_score(postcode1: Optional[str], postcode2: Optional[str]) -> float:
+    if postcode1 is None or postcode2 is None:
+        return 0
+
+    zip1_formatted = format_zip(postcode1)
+    zip2_formatted = format_zip(postcode2)
+    if len(zip1_formatted) == len(zip2_formatted):
+        zip_formatted_score = (fuzz.ratio(zip1_formatted, zip2_formatted) / 100) ** 2 * 2 - 1
+    else:
+        zip_formatted_score = (fuzz.ratio(zip1_formatted[:5], zip2_formatted[:5]) / 100) ** 2 * 2 - 1
+    zip_raw_score = (fuzz.ratio(postcode1, postcode2) / 100) ** 2 * 2 - 1
+
+    return max(zip_formatted_score or 0, zip_raw_score or 0)
+
+
+def address_similarity(
+    address1: str | ParsedAddress, address2: str | ParsedAddress, score_cutoff: Optional[float] = None
+) -> float:
     """
     Calculate the similarity between two addresses.
 
     Parameters
     ----------
-    address1 : str
-        The first address to compare.
-    address2 : str
+    address1 : str | ParsedAddress
+        The first address to compare. Pass a `ParsedAddress` when comparing one address against many, so that it
+        is only parsed once.
+    address2 : str | ParsedAddress
         The second address to compare.
+    score_cutoff : Optional[float]
+        If given, scores below the cutoff are returned as 0. The cheapest, most decisive components (state, ZIP,
+        house number) are scored first, and scoring stops as soon as the cutoff can no longer be reached.
+        Scores at or above the cutoff are unchanged.
 
     Returns
     -------
     dict
         A dictionary containing the similarity scores for the address components.
     """
-    full_score_str = fuzz.WRatio(address1, address2) / 100 - 0.2
+    text1 = address1.text if isinstance(address1, ParsedAddress) else address1
+    text2 = address2.text if isinstance(address2, ParsedAddress) else address2
+    if score_cutoff is not None:
+        return _address_similarity_with_cutoff(address1, address2, text1, text2, score_cutoff)
+
+    full_score_str = fuzz.WRatio(text1, text2) / 100 - 0.2
 
     try:
-        parsed_address1 = parse_address(address1)
-        parsed_address2 = parse_address(address2)
+        parsed_address1 = address1 if isinstance(address1, ParsedAddress) else ParsedAddress.parse(address1)
+        parsed_address2 = address2 if isinstance(address2, ParsedAddress) else ParsedAddress.parse(address2)
     except Exception:
         return full_score_str
 
-    house_number_score = (
-        None
-        if parsed_address1.house_number is None or parsed_address2.house_number is None
-        else ((fuzz.ratio(parsed_address1.house_number, parsed_address2.house_number) / 100) ** 3 * 2 - 1)
-    )
-    road_score = (
-        None
-        if parsed_address1.road is None or parsed_address2.road is None
-        else ((fuzz.WRatio(parsed_address1.road, parsed_address2.road) / 100) * 2 - 1)
-    )
-    city_score = (
-        None
-        if parsed_address1.city is None or parsed_address2.city is None
-        else ((fuzz.WRatio(parsed_address1.city, parsed_address2.city) / 100) * 2 - 1)
-    )
-    state_score = (
-        None
-        if parsed_address1.state is None or parsed_address2.state is None
-        else (1 if parsed_address1.state == parsed_address2.state else -1)
-    )
-
-    if parsed_address1.postcode is not None and parsed_address2.postcode is not None:
-        zip1_formatted = format_zip(parsed_address1.postcode)
-        zip2_formatted = format_zip(parsed_address2.postcode)
-        if len(zip1_formatted) == len(zip2_formatted):
-            zip_formatted_score = (fuzz.ratio(zip1_formatted, zip2_formatted) / 100) ** 2 * 2 - 1
-        else:
-            zip_formatted_score = (fuzz.ratio(zip1_formatted[:5], zip2_formatted[:5]) / 100) ** 2 * 2 - 1
-    else:
-        zip_formatted_score = None
-
-    zip_raw_score = (
-        None
-        if parsed_address1.postcode is None or parsed_address2.postcode is None
-        else ((fuzz.ratio(parsed_address1.postcode, parsed_address2.postcode) / 100) ** 2 * 2 - 1)
-    )
-
-    zip_score = max(zip_formatted_score or 0, zip_raw_score or 0)
+    house_number_score = _house_number_score(parsed_address1.house_number, parsed_address2.house_number)
+    road_score = _road_score(parsed_address1.road, parsed_address2.road)
+    city_score = _city_score(parsed_address1.city, parsed_address2.city)
+    state_score = _state_score(parsed_address1.state, parsed_address2.state)
+    zip_score = _zip_score(parsed_address1.postcode, parsed_address2.postcode)
 
     to_count = [
         x for x in [house_number_score, road_score, city_score, state_score, zip_score] if x is not None
@@ -112,6 +504,197 @@ def address_similarity(address1: str, address2: str) -> float:
     return max(full_score, full_score_str)
 
 
+def _address_similarity_with_cutoff(
+    address1: str | ParsedAddress, address2: str | ParsedAddress, text1: str, text2: str, score_cutoff: float
+) -> float:
+    # The full string score is WRatio / 100 - 0.2, so it can never be more than 0.8
+    full_str_reachable = score_cutoff <= 0.8
+
+    def full_score_str(min_score: float) -> float:
+        score = wratio(text1, text2, (min_score + 0.2) * 100) / 100 - 0.2
+        return score if score >= min_score else 0
+
+    try:
+        parsed_address1 = address1 if isinstance(address1, ParsedAddress) else ParsedAddress.parse(address1)
+        parsed_address2 = address2 if isinstance(address2, ParsedAddress) else ParsedAddress.parse(address2)
+    except Exception:
+        return full_score_str(score_cutoff) if full_str_reachable else 0
+
+    # Cheapest and most decisive first. Components missing from either address don't count towards the score.
+    pending = [
+        (field, scorer)
+        for field, scorer in [
+            ("state", _state_score),
+            ("postcode", _zip_score),
+            ("house_number", _house_number_score),
+            ("road", _road_score),
+            ("city", _city_score),
+        ]
+        if field == "postcode"
+        or (getattr(parsed_address1, field) is not None and getattr(parsed_address2, field) is not None)
+    ]
+    scores: dict[str, float] = {}
+    score_sum = 0
+    for i, (field, scorer) in enumerate(pending):
+        # The best case for the rest is 1 each, so this component needs at least this much to reach the cutoff
+        n_remaining = len(pending) - i - 1
+        min_component = score_cutoff * len(pending) - score_sum - n_remaining
+        if min_component > 1 + CUTOFF_EPSILON:
+            break
+        if scorer in (_road_score, _city_score):
+            score = scorer(getattr(parsed_address1, field), getattr(parsed_address2, field), min_component)
+        else:
+            score = scorer(getattr(parsed_address1, field), getattr(parsed_address2, field))
+        scores[field] = score
+        score_sum += score
+    else:
+        # Every component was scored: sum in the same order as address_similarity so the result is identical
+        to_count = [
+            scores[field]
+            for field in ["house_number", "road", "city", "state", "postcode"]
+            if field in scores
+        ]
+        full_score = max(0, sum(to_count) / len(to_count))
+        if full_score >= score_cutoff:
+            return max(full_score, full_score_str(full_score)) if full_str_reachable else full_score
+
+    return full_score_str(score_cutoff) if full_str_reachable else 0
+
+
+def _component_scores(
+    query_value: Optional[str], candidate_values: list[Optional[str]], scorer, workers: int
+) -> np.ndarray:
+    """
+    Score one component of the query against the same component of every candidate, in one batched call.
+
+    Returns the raw rapidfuzz scores (0-100), with NaN wherever either side is missing.
+    """
+    scores = np.full(len(candidate_values), np.nan)
+    present = np.array([value is not None for value in candidate_values], dtype=bool)
+    if query_value is None or not present.any():
+        return scores
+    choices = [value for value in candidate_values if value is not None]
+    scores[present] = process.cdist([query_value], choices, scorer=scorer, dtype=np.float64, workers=workers)[
+        0
+    ]
+    return scores
+
+
+def address_similarity_many(
+    query: str | ParsedAddress, candidates: Sequence[str | ParsedAddress], workers: int = 1
+) -> np.ndarray:
+    """
+    Calculate the similarity between one address and many candidates.
+
+    The result is identical to calling `address_similarity(query, candidate)` for each candidate, but the query is
+    parsed once and each address component is scored against all candidates in a single batched rapidfuzz call.
+
+    Parameters
+    ----------
+    query : str | ParsedAddress
+        The address to compare.
+    candidates : Sequence[str | ParsedAddress]
+        The addresses to compare against. Pass `ParsedAddress`es to avoid parsing them here.
+    workers : int
+        The number of threads rapidfuzz uses for each batched call (-1 for all CPUs).
+
+    Returns
+    -------
+    np.ndarray
+        The similarity score for each candidate.
+    """
+    query_text = query.text if isinstance(query, ParsedAddress) else query
+    candidate_texts = [
+        candidate.text if isinstance(candidate, ParsedAddress) else candidate for candidate in candidates
+    ]
+    if not candidate_texts:
+        return np.empty(0)
+    full_score_str = (
+        process.cdist([query_text], candidate_texts, scorer=fuzz.WRatio, dtype=np.float64, workers=workers)[0]
+        / 100
+        - 0.2
+    )
+
+    try:
+        parsed_query = query if isinstance(query, ParsedAddress) else ParsedAddress.parse(query)
+    except Exception:
+        return full_score_str
+
+    parsed_candidates: list[Optional[ParsedAddress]] = []
+    for candidate in candidates:
+        if isinstance(candidate, ParsedAddress):
+            parsed_candidates.append(candidate)
+            continue
+        try:
+            parsed_candidates.append(ParsedAddress.parse(candidate))
+        except Exception:
+            parsed_candidates.append(None)
+    parsed_ok = np.array([candidate is not None for candidate in parsed_candidates], dtype=bool)
+    empty = Address()
+    parsed_candidates = [empty if candidate is None else candidate for candidate in parsed_candidates]
+
+    def column(field: str) -> list[Optional[str]]:
+        return [getattr(candidate, field) for candidate in parsed_candidates]
+
+    house_number_score = (
+        np.power(
+            _component_scores(parsed_query.house_number, column("house_number"), fuzz.ratio, workers) / 100, 3
+        )
+        * 2
+        - 1
+    )
+    road_score = _component_scores(parsed_query.road, column("road"), fuzz.WRatio, workers) / 100 * 2 - 1
+    city_score = _component_scores(parsed_query.city, column("city"), fuzz.WRatio, workers) / 100 * 2 - 1
+
+    state_score = np.full(len(parsed_candidates), np.nan)
+    if parsed_query.state is not None:
+        for i, state in enumerate(column("state")):
+            if state is not None:
+                state_score[i] = 1 if state == parsed_query.state else -1
+
+    postcodes = column("postcode")
+    if parsed_query.postcode is not None:
+        query_zip_formatted = format_zip(parsed_query.postcode)
+        zips_formatted = [None if postcode is None else format_zip(postcode) for postcode in postcodes]
+        same_length = np.array(
+            [
+                zip_formatted is not None and len(zip_formatted) == len(query_zip_formatted)
+                for zip_formatted in zips_formatted
+            ]
+        )
+        zip_formatted_ratio = np.where(
+            same_length,
+            _component_scores(query_zip_formatted, zips_formatted, fuzz.ratio, workers),
+            _component_scores(
+                query_zip_formatted[:5],
+                [None if zip_formatted is None else zip_formatted[:5] for zip_formatted in zips_formatted],
+                fuzz.ratio,
+                workers,
+            ),
+        )
+        zip_formatted_score = np.power(zip_formatted_ratio / 100, 2) * 2 - 1
+        zip_raw_score = (
+            np.power(_component_scores(parsed_query.postcode, postcodes, fuzz.ratio, workers) / 100, 2) * 2
+            - 1
+        )
+        zip_score = np.where(
+            np.isnan(zip_formatted_score), 0.0, np.maximum(zip_formatted_score, zip_raw_score)
+        )
+    else:
+        zip_score = np.zeros(len(parsed_candidates))
+
+    # Sum in the same order as address_similarity so the floating point results are identical
+    total = np.zeros(len(parsed_candidates))
+    count = np.zeros(len(parsed_candidates))
+    for score in [house_number_score, road_score, city_score, state_score, zip_score]:
+        present = ~np.isnan(score)
+        total = total + np.where(present, score, 0.0)
+        count += present
+    full_score = np.maximum(0, total / count)
+
+    return np.where(parsed_ok, np.maximum(full_score, full_score_str), full_score_str)
+
+
 if __name__ == "__main__":
     command = input(">>>")
     while command != "q":
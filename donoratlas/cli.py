@@ -0,0 +1,430 @@
+"""
+The `donoratlas` command, for running bulk jobs over large files.
+
+Each subcommand streams a CSV, Parquet or JSONL file in chunks, spreads the chunks across worker processes,
+and writes the input rows with the results appended as new columns, in input order. At most two chunks per
+worker are in flight at once, so memory stays bounded however large the file is. For example
+
+    donoratlas parse-names donors.csv parsed.parquet --column full_name --workers 8
+    donoratlas match-schools educations.jsonl matched.csv --column education --chunk-size 5000
+"""
+
+import argparse
+import bz2
+import gzip
+import json
+import logging
+import lzma
+import os
+import time
+from collections import deque
+from functools import partial
+from typing import Any, Callable, Iterator, NamedTuple, Optional
+
+import pandas as pd
+
+from donoratlas.addresses import ADDRESS_FIELDS, parse_addresses
+from donoratlas.names import NameTyper, parse_name
+from donoratlas.parallel import imap_bounded
+from donoratlas.schools.index import get_index
+from donoratlas.schools.match_school import match_strings_to_school_ids
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 10_000
+
+FORMATS = ("csv", "jsonl", "parquet")
+
+# The compressed text files that can be read and written, by extension
+COMPRESSIONS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+NAME_FIELDS = ("title", "first", "middle", "last", "suffix")
+
+# The separator between the ids of an ambiguous school match
+SCHOOL_ID_SEPARATOR = ";"
+
+
+def detect_format(path: str) -> str:
+    """
+    Detect the format of a file from its extension (ignoring a compression extension like ".gz", for CSV and
+    JSONL).
+
+    Raises
+    ------
+        ValueError: If the extension isn't a known format.
+    """
+    name, extension = os.path.splitext(path.lower())
+    compressed = extension in COMPRESSIONS
+    if compressed:
+        extension = os.path.splitext(name)[1]
+    formats = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".parquet": "parquet", ".pq": "parquet"}
+    if extension not in formats or compressed and formats[extension] == "parquet":
+        raise ValueError(f"Can't tell the format of {path!r}; pass one of {', '.join(FORMATS)}")
+    return formats[extension]
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Reading and writing Parquet files requires pyarrow (pip install pyarrow)") from e
+    return pyarrow
+
+
+def read_chunks(path: str, file_format: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Read a file a chunk of rows at a time.
+
+    CSV columns are read as strings, so e.g. zip codes keep their leading zeros, and only empty cells are
+    missing.
+
+    Parameters
+    ----------
+        path (str): The file.
+        file_format (str): "csv", "jsonl" or "parquet".
+        chunk_size (int): The number of rows in each chunk.
+
+    Yields
+    ------
+        pd.DataFrame: The rows of each chunk.
+    """
+    if file_format == "csv":
+        with pd.read_csv(
+            path, dtype=str, keep_default_na=False, na_values=[""], chunksize=chunk_size
+        ) as reader:
+            yield from reader
+    elif file_format == "jsonl":
+        with pd.read_json(path, lines=True, dtype=False, chunksize=chunk_size) as reader:
+            yield from reader
+    elif file_format == "parquet":
+        pyarrow = _import_pyarrow()
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        raise ValueError(f"Unknown format {file_format!r}")
+
+
+class ChunkWriter:
+    """
+    Writes chunks of rows to a CSV, Parquet or JSONL file (compressed if its name ends in e.g. ".gz"),
+    overwriting it.
+
+    Attributes
+    ----------
+        path (str): The file.
+        file_format (str): "csv", "jsonl" or "parquet".
+    """
+
+    def __init__(self, path: str, file_format: str):
+        if file_format not in FORMATS:
+            raise ValueError(f"Unknown format {file_format!r}")
+        self.path = path
+        self.file_format = file_format
+        self._pyarrow = _import_pyarrow() if file_format == "parquet" else None
+        if file_format == "parquet":
+            self._file = None
+        else:
+            open_file = COMPRESSIONS.get(os.path.splitext(path.lower())[1], open)
+            self._file = open_file(path, "wt", encoding="utf-8", newline="")
+        self._parquet_writer = None
+        self._header = True
+
+    def write(self, chunk: pd.DataFrame):
+        if self.file_format == "csv":
+            chunk.to_csv(self._file, header=self._header, index=False)
+            self._header = False
+        elif self.file_format == "jsonl":
+            if len(chunk):
+                lines = chunk.to_json(orient="records", lines=True, force_ascii=False)
+                self._file.write(lines if lines.endswith("\n") else lines + "\n")
+        else:
+            self._write_parquet(chunk)
+
+    def _write_parquet(self, chunk: pd.DataFrame):
+        pyarrow = self._pyarrow
+        if self._parquet_writer is None:
+            # A column that's all missing in the first chunk would be typed as null, which later chunks can't
+            # be cast to, so assume such columns hold strings
+            schema = pyarrow.Schema.from_pandas(chunk, preserve_index=False)
+            schema = pyarrow.schema(
+                [
+                    field.with_type(pyarrow.string()) if pyarrow.types.is_null(field.type) else field
+                    for field in schema
+                ]
+            )
+            self._parquet_writer = pyarrow.parquet.ParquetWriter(self.path, schema)
+        table = pyarrow.Table.from_pandas(chunk, schema=self._parquet_writer.schema, preserve_index=False)
+        self._parquet_writer.write_table(table)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        elif self.file_format == "parquet":
+            # Nothing was written, but the output should still exist
+            pd.DataFrame().to_parquet(self.path)
+
+    def __enter__(self) -> "ChunkWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _or_none(function: Callable[[str], Any], value: Optional[str]) -> Any:
+    if value is None:
+        return None
+    try:
+        return function(value)
+    except Exception:
+        logger.debug("Failed on %r", value, exc_info=True)
+        return None
+
+
+def _parse_names(names: list[Optional[str]]) -> dict[str, list]:
+    parsed = [_or_none(parse_name, name) for name in names]
+    return {
+        field: [None if name is None else getattr(name, field) for name in parsed] for field in NAME_FIELDS
+    }
+
+
+_name_typer: Optional[NameTyper] = None
+
+
+def _get_name_typer() -> NameTyper:
+    global _name_typer
+    if _name_typer is None:
+        _name_typer = NameTyper()
+    return _name_typer
+
+
+def _classify_names(names: list[Optional[str]]) -> dict[str, list]:
+    present = [name for name in names if name is not None]
+    # Chunks are already spread across processes, so each is classified in its worker
+    classified = iter(_get_name_typer().classify(present, workers=1, chunk_size=max(len(present), 1)))
+    return {"is_individual": [None if name is None else next(classified) for name in names]}
+
+
+def _parse_addresses(addresses: list[Optional[str]]) -> dict[str, list]:
+    return parse_addresses(addresses, workers=1)
+
+
+def _match_schools(queries: list[Optional[str]]) -> dict[str, list]:
+    present = [query for query in queries if query is not None]
+    matched = iter(match_strings_to_school_ids(present, workers=1) if present else [])
+    school_ids = []
+    for query in queries:
+        result = None if query is None else next(matched)
+        if result is None:
+            school_ids.append(None)
+        elif isinstance(result, str):
+            school_ids.append(result)
+        else:
+            school_ids.append(SCHOOL_ID_SEPARATOR.join(result))
+    return {"school_ids": school_ids}
+
+
+class Command(NamedTuple):
+    """
+    A subcommand: what it does to a chunk of input values, and how to get ready to do it.
+
+    Attributes
+    ----------
+        help (str): The subcommand's description.
+        column (str): The input column it reads by default.
+        handle_chunk (Callable[[list[Optional[str]]], dict[str, list]]): Maps a chunk of values (None if
+            missing) to the output columns, aligned to the input.
+        load (Callable[[], Any]): Loads what `handle_chunk` needs. It's run before the workers start, so
+            forked workers share it rather than each loading their own.
+    """
+
+    help: str
+    column: str
+    handle_chunk: Callable[[list[Optional[str]]], dict[str, list]]
+    load: Callable[[], Any]
+
+
+COMMANDS = {
+    "parse-names": Command(
+        "Parse names into title, first, middle, last and suffix.", "name", _parse_names, lambda: None
+    ),
+    "classify-names": Command(
+        "Classify names as individuals or not.", "name", _classify_names, _get_name_typer
+    ),
+    "parse-addresses": Command(
+        f"Parse addresses into {', '.join(ADDRESS_FIELDS)}.", "address", _parse_addresses, lambda: None
+    ),
+    "match-schools": Command(
+        f"Match education strings to school ids ({SCHOOL_ID_SEPARATOR!r}-separated if ambiguous).",
+        "query",
+        _match_schools,
+        get_index,
+    ),
+}
+
+
+def _handle_chunk(command: str, values: list[Optional[str]]) -> dict[str, list]:
+    return COMMANDS[command].handle_chunk(values)
+
+
+def _column_values(chunk: pd.DataFrame, column: str) -> list[Optional[str]]:
+    return [value if isinstance(value, str) and value.strip() else None for value in chunk[column]]
+
+
+def run(
+    command: str,
+    input_path: str,
+    output_path: str,
+    column: Optional[str] = None,
+    input_format: Optional[str] = None,
+    output_format: Optional[str] = None,
+    workers: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> dict[str, Any]:
+    """
+    Run a subcommand over a file.
+
+    Parameters
+    ----------
+        command (str): The subcommand, a key of `COMMANDS`.
+        input_path (str): The file to read.
+        output_path (str): The file to write the input, with the results appended as new columns, to.
+        column (Optional[str]): The input column to process. Defaults to the subcommand's.
+        input_format (Optional[str]): "csv", "jsonl" or "parquet". Defaults to the extension of `input_path`.
+        output_format (Optional[str]): "csv", "jsonl" or "parquet". Defaults to the extension of
+            `output_path`.
+        workers (Optional[int]): The number of worker processes. Defaults to the number of CPUs. With 1
+            worker, chunks are processed in the current process.
+        chunk_size (int): The number of rows read, and sent to a worker, at a time.
+
+    Returns
+    -------
+        dict[str, Any]: The number of rows and chunks processed, the seconds taken, and the rows per second.
+    """
+    spec = COMMANDS[command]
+    column = spec.column if column is None else column
+    input_format = detect_format(input_path) if input_format is None else input_format
+    output_format = detect_format(output_path) if output_format is None else output_format
+    workers = workers or os.cpu_count() or 1
+
+    start = time.perf_counter()
+    spec.load()
+    load_seconds = time.perf_counter() - start
+
+    n_rows = 0
+    n_chunks = 0
+
+    def checked(chunks: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        for chunk in chunks:
+            if column not in chunk.columns:
+                raise ValueError(
+                    f"{input_path!r} has no column {column!r} (columns: {', '.join(chunk.columns)})"
+                )
+            yield chunk
+
+    def write(chunk: pd.DataFrame, results: dict[str, list]):
+        nonlocal n_rows, n_chunks
+        writer.write(chunk.assign(**results))
+        n_rows += len(chunk)
+        n_chunks += 1
+        elapsed = time.perf_counter() - start
+        logger.info("%s rows done (%s rows/s)", f"{n_rows:,}", f"{n_rows / elapsed:,.0f}")
+
+    chunks = checked(read_chunks(input_path, input_format, chunk_size))
+    with ChunkWriter(output_path, output_format) as writer:
+        if workers == 1:
+            for chunk in chunks:
+                write(chunk, spec.handle_chunk(_column_values(chunk, column)))
+        else:
+            # Chunks are queued here as they're sent to the workers, and results come back in the same order
+            pending = deque()
+
+            def values(chunks: Iterator[pd.DataFrame]) -> Iterator[list[Optional[str]]]:
+                for chunk in chunks:
+                    pending.append(chunk)
+                    yield _column_values(chunk, column)
+
+            for results in imap_bounded(partial(_handle_chunk, command), values(chunks), workers):
+                write(pending.popleft(), results)
+
+    seconds = time.perf_counter() - start
+    return {
+        "rows": n_rows,
+        "chunks": n_chunks,
+        "workers": workers,
+        "load_seconds": load_seconds,
+        "seconds": seconds,
+        "rows_per_second": n_rows / seconds if seconds else 0.0,
+    }
+
+
+def print_summary(summary: dict[str, Any]):
+    print(f"rows:       {summary['rows']:,} in {summary['chunks']:,} chunks, on {summary['workers']} workers")
+    print(f"time:       {summary['seconds']:,.1f}s (loading: {summary['load_seconds']:,.1f}s)")
+    print(f"throughput: {summary['rows_per_second']:,.1f} rows/s")
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="donoratlas", description="Parse and match large files of records.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, spec in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=spec.help, description=spec.help)
+        subparser.add_argument("input", help="The CSV, Parquet or JSONL file to read.")
+        subparser.add_argument("output", help="The CSV, Parquet or JSONL file to write.")
+        subparser.add_argument(
+            "--column", default=spec.column, help=f"The input column to process (default: {spec.column})."
+        )
+        subparser.add_argument("--input-format", choices=FORMATS, help="Default: from the input's extension.")
+        subparser.add_argument(
+            "--output-format", choices=FORMATS, help="Default: from the output's extension."
+        )
+        subparser.add_argument(
+            "--workers", type=int, default=None, help="Worker processes (default: the number of CPUs)."
+        )
+        subparser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help=f"Rows per chunk (default: {DEFAULT_CHUNK_SIZE:,}).",
+        )
+        subparser.add_argument("--summary", help="Also write the throughput summary to this JSON file.")
+        subparser.add_argument("-v", "--verbose", action="store_true", help="Log progress after each chunk.")
+    return parser
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    try:
+        summary = run(
+            args.command,
+            args.input,
+            args.output,
+            column=args.column,
+            input_format=args.input_format,
+            output_format=args.output_format,
+            workers=args.workers,
+            chunk_size=args.chunk_size,
+        )
+    except (ValueError, ImportError) as e:
+        parser.exit(2, f"donoratlas {args.command}: error: {e}\n")
+
+    print_summary(summary)
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+from typing import Optional
+
+from rapidfuzz import fuzz
+
+# Slack for floating point error when turning a cutoff on our scores into a cutoff on rapidfuzz scores
+CUTOFF_EPSILON = 1e-9
+
+
+def wratio(s1: str, s2: str, min_score: Optional[float] = None) -> float:
+    """
+    fuzz.WRatio, with an optional minimum below which rapidfuzz may give up early and return 0.
+
+    Parameters
+    ----------
+        s1 (str): The first string.
+        s2 (str): The second string.
+        min_score (Optional[float]): The minimum score (0-100) of interest. Scores below it may be returned as 0.
+
+    Returns
+    -------
+        float: The score, between 0 and 100.
+    """
+    if min_score is None or min_score <= 0:
+        return fuzz.WRatio(s1, s2)
+    if min_score > 100:
+        return 0
+    return fuzz.WRatio(s1, s2, score_cutoff=min_score - CUTOFF_EPSILON)
@@ -0,0 +1,128 @@
+from collections import defaultdict
+from typing import Optional, Sequence
+
+from donoratlas.addresses import (
+    _canonical_road,
+    _canonical_unit,
+    _road_score,
+    format_zip,
+    parse_addresses,
+)
+from donoratlas.names import PersonName
+
+
+def _find(parents: list[int], i: int) -> int:
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def group_households(
+    addresses: Sequence[str],
+    last_names: Sequence[Optional[str]],
+    road_threshold: float = 0.8,
+    workers: Optional[int] = None,
+) -> list[int]:
+    """
+    Group individuals into households: people with the same street address and last name.
+
+    Addresses are parsed in bulk and blocked by ZIP5 and house number, so only people within a block are ever
+    compared. Within a block, two people are in the same household if their roads score at least `road_threshold`
+    (with the road scorer used by `address_similarity`), their last names are equal as `PersonName`s, and their
+    units are the same (or both missing). Differences in ZIP+4, unit designators ("Apt 4" vs "#4") and street
+    suffixes ("Street" vs "St") are ignored.
+
+    People with no unit are also merged into the household with a unit on the same road and last name, but only if
+    there is exactly one such unit in the block. If there are several ("1 Main St Apt 1", "1 Main St" and
+    "1 Main St Apt 2"), the person with no unit can't be placed, so each unit and the unit-less people stay separate
+    households.
+
+    Parameters
+    ----------
+    addresses : Sequence[str]
+        The address of each person.
+    last_names : Sequence[Optional[str]]
+        The last name of each person, aligned with `addresses`.
+    road_threshold : float
+        The minimum road score (between -1 and 1) for two roads to be considered the same.
+    workers : Optional[int]
+        The number of worker processes used to parse the addresses.
+
+    Returns
+    -------
+    list[int]
+        A household id for each person, numbered in order of first appearance.
+        People with no last name, or whose address has no ZIP code, house number or road, get their own household.
+    """
+    if len(addresses) != len(last_names):
+        raise ValueError("addresses and last_names must have the same length")
+
+    columns = parse_addresses(addresses, workers=workers)
+    parents = list(range(len(addresses)))
+
+    # Block on ZIP5 and house number, then collapse exact duplicates (same road, unit and last name) in each block
+    blocks: dict[tuple[str, str], dict[tuple[str, str, str], list[int]]] = defaultdict(
+        lambda: defaultdict(list)
+    )
+    for i, (house_number, road, unit, postcode, last_name) in enumerate(
+        zip(columns["house_number"], columns["road"], columns["unit"], columns["postcode"], last_names)
+    ):
+        if (
+            not house_number
+            or not road
+            or not postcode
+            or not isinstance(last_name, str)
+            or not last_name.strip()
+        ):
+            continue
+        zip5 = format_zip(postcode)[:5]
+        if len(zip5) != 5:
+            continue
+        exact_key = (
+            _canonical_road(road),
+            "" if unit is None else _canonical_unit(unit),
+            last_name.strip().casefold(),
+        )
+        blocks[(zip5, house_number.strip().casefold())][exact_key].append(i)
+
+    for block in blocks.values():
+        representatives = []
+        for (road, unit, last_name), indices in block.items():
+            for i in indices[1:]:
+                parents[_find(parents, i)] = _find(parents, indices[0])
+            representatives.append((indices[0], road, unit, PersonName(last=last_name)))
+
+        def same_road_and_name(i: int, j: int) -> bool:
+            _, road_i, _, name_i = representatives[i]
+            _, road_j, _, name_j = representatives[j]
+            return name_i == name_j and _road_score(road_i, road_j) >= road_threshold
+
+        # Merge people with the same unit (or both without one)
+        for a, (i, _, unit_i, _) in enumerate(representatives):
+            for b in range(a + 1, len(representatives)):
+                j, _, unit_j, _ = representatives[b]
+                if unit_i == unit_j and same_road_and_name(a, b):
+                    parents[_find(parents, j)] = _find(parents, i)
+
+        # Then merge each group without a unit into the group with a unit on the same road and last name, but only
+        # if there is exactly one such unit. Merging a missing unit with any unit would otherwise chain "Apt 1" and
+        # "Apt 2" together through "1 Main St"
+        without_unit: dict[int, list[int]] = defaultdict(list)
+        for a, (i, _, unit, _) in enumerate(representatives):
+            if not unit:
+                without_unit[_find(parents, i)].append(a)
+        for root, members in without_unit.items():
+            matches = [
+                b
+                for b, (_, _, unit, _) in enumerate(representatives)
+                if unit and any(same_road_and_name(a, b) for a in members)
+            ]
+            if len({representatives[b][2] for b in matches}) == 1:
+                for b in matches:
+                    parents[_find(parents, representatives[b][0])] = _find(parents, root)
+
+    root_to_household: dict[int, int] = {}
+    return [
+        root_to_household.setdefault(_find(parents, i), len(root_to_household)) for i in range(len(parents))
+    ]
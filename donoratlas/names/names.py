@@ -1,14 +1,18 @@
 import json
 import os
 import re
-from typing import Optional
+import time
+from itertools import islice
+from typing import Callable, Iterable, Iterator, Optional
 
 from nameparser.config.titles import TITLES
 from nicknames import NickNamer
 from pydantic import BaseModel
 from rapidfuzz import fuzz
 
+from donoratlas.fuzzy import CUTOFF_EPSILON, wratio
 from donoratlas.names.parser import NameParser
+from donoratlas.parallel import imap_bounded
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -17,6 +21,10 @@ STATE_NAME_TO_ABBREV = json.load(open(os.path.join(BASE_DIR, "static", "states.j
 name_parser = NameParser()
 nick_namer = NickNamer()
 
+# The typer used by classification worker processes. Forked workers inherit it from the parent (copy-on-write),
+# spawned workers build their own in `_init_classify_worker`.
+_classify_typer: Optional["NameTyper"] = None
+
 
 def get_nicknames(name: str) -> set[str]:
     """
@@ -193,6 +201,7 @@ def name_similarity(
     name2: Optional[str] = None,
     name1_parsed: Optional[PersonName] = None,
     name2_parsed: Optional[PersonName] = None,
+    score_cutoff: Optional[float] = None,
 ) -> dict[str, float]:
     """
     Calculate the similarity between two names.
@@ -203,6 +212,9 @@ def name_similarity(
         name2 (str): The second name.
         name1_parsed (PersonName): The first name parsed.
         name2_parsed (PersonName): The second name parsed.
+        score_cutoff (Optional[float]): If given, pairs whose "full" score would be below the cutoff return
+            {"full": 0}. The last name is scored first, and the remaining WRatio calls are skipped (or given a
+            rapidfuzz score_cutoff) once the cutoff is out of reach. Results at or above the cutoff are unchanged.
 
     Returns
     -------
@@ -257,7 +269,31 @@ def name_similarity(
     # These scores are between -1 and 1.
     score = {"first": 0, "middle": 0, "last": 0}
 
-    if name1_first is not None and name2_first is not None:
+    # With a cutoff, track whether full_parsed_score can still reach it, assuming every component not yet scored is 1
+    has_first = name1_first is not None and name2_first is not None
+    has_middle = name1_middle is not None and name2_middle is not None
+    parsed_reachable = True
+
+    def min_wratio(weight: float, best_others: float) -> Optional[float]:
+        """The minimum WRatio for a "WRatio / 50 - 1" component to keep full_parsed_score above the cutoff."""
+        if score_cutoff is None:
+            return None
+        return ((score_cutoff - best_others) / weight + 1) * 50
+
+    def can_reach(best_parsed_score: float) -> bool:
+        return score_cutoff is None or best_parsed_score >= score_cutoff - CUTOFF_EPSILON
+
+    if name1_last is not None and name2_last is not None:
+        if name1_last == name2_last:
+            score["last"] = 1
+        else:
+            last_score = (
+                wratio(name1_last, name2_last, min_wratio(1 / 2, has_first / 2 + has_middle / 4)) / 50
+            )
+            score["last"] = last_score - 1
+    parsed_reachable = can_reach(has_first / 2 + has_middle / 4 + score["last"] / 2)
+
+    if parsed_reachable and has_first:
         if name1_first == name2_first:
             score["first"] = 1
         elif name1_first in [
@@ -269,17 +305,13 @@ def name_similarity(
             first_score = fuzz.WRatio(name1_first, name2_first) / 1000
             score["first"] = first_score + 0.9
         else:
-            first_score = fuzz.WRatio(name1_first, name2_first) / 50
+            first_score = (
+                wratio(name1_first, name2_first, min_wratio(1 / 2, score["last"] / 2 + has_middle / 4)) / 50
+            )
             score["first"] = first_score - 1
+        parsed_reachable = can_reach(score["first"] / 2 + has_middle / 4 + score["last"] / 2)
 
-    if name1_last is not None and name2_last is not None:
-        if name1_last == name2_last:
-            score["last"] = 1
-        else:
-            last_score = fuzz.WRatio(name1_last, name2_last) / 50
-            score["last"] = last_score - 1
-
-    if name1_middle is not None and name2_middle is not None:
+    if parsed_reachable and has_middle:
         # Check for full name match
         if (
             (len(name1_middle) == 1 and len(name2_middle) == 1 and name1_middle == name2_middle)
@@ -294,13 +326,26 @@ def name_similarity(
         elif len(name1_middle) > 1 and len(name2_middle) > 1 and name1_middle == name2_middle:
             score["middle"] = 1
         else:
-            middle_score = fuzz.WRatio(name1_middle, name2_middle) / 50
+            middle_score = (
+                wratio(name1_middle, name2_middle, min_wratio(1 / 4, score["first"] / 2 + score["last"] / 2))
+                / 50
+            )
             score["middle"] = middle_score - 1
 
-    # Also calculate the full WRatio score, in case of bad parsing
-    full_score = fuzz.WRatio(name1, name2) / 100 - 0.1
     full_parsed_score = min(1, (score["first"] / 2) + (score["middle"] / 4) + (score["last"] / 2))
 
+    if score_cutoff is not None and not (parsed_reachable and full_parsed_score >= score_cutoff):
+        # The parsed score can't reach the cutoff, so only the full string score (at most 0.9) still could
+        if score_cutoff > 0.9:
+            return {"full": 0}
+        full_score = wratio(name1, name2, (score_cutoff + 0.1) * 100) / 100 - 0.1
+        return {"full": full_score} if full_score >= score_cutoff else {"full": 0}
+
+    # Also calculate the full WRatio score, in case of bad parsing. It only matters if it beats the parsed score.
+    full_score = (
+        wratio(name1, name2, None if score_cutoff is None else (full_parsed_score + 0.1) * 100) / 100 - 0.1
+    )
+
     if full_score > full_parsed_score:
         return {"full": full_score}
     else:
@@ -555,6 +600,92 @@ class NameTyper:
 
         return sum(name_scores) > 0
 
+    def iter_classify(
+        self,
+        names: Iterable[str],
+        workers: Optional[int] = None,
+        chunk_size: int = 10_000,
+        progress: Optional[Callable[[int, float], None]] = None,
+    ) -> Iterator[bool]:
+        """
+        Lazily classify names as individuals or not, using multiple processes.
+
+        The input is consumed in chunks, with at most two chunks in flight per worker, so arbitrarily long
+        iterables are streamed with bounded memory. Results are yielded in input order.
+
+        Parameters
+        ----------
+            names (Iterable[str]): The names to classify.
+            workers (Optional[int]): The number of worker processes. Defaults to the number of CPUs.
+                With 1 worker, names are classified in the current process.
+            chunk_size (int): The number of names sent to a worker at a time.
+            progress (Optional[Callable[[int, float], None]]): Called after each chunk with the number of names
+                classified so far and the elapsed time in seconds.
+
+        Yields
+        ------
+            bool: Whether each name is an individual (see `is_individual`).
+        """
+        global _classify_typer
+
+        workers = workers or os.cpu_count() or 1
+        names = iter(names)
+        chunks = iter(lambda: list(islice(names, chunk_size)), [])
+        start = time.perf_counter()
+        n_done = 0
+
+        if workers == 1:
+            for chunk in chunks:
+                yield from (self.is_individual(name) for name in chunk)
+                n_done += len(chunk)
+                if progress is not None:
+                    progress(n_done, time.perf_counter() - start)
+            return
+
+        # Forked workers use this typer, sharing its lexicons copy-on-write
+        _classify_typer = self
+        try:
+            for results in imap_bounded(_classify_chunk, chunks, workers, initializer=_init_classify_worker):
+                n_done += len(results)
+                if progress is not None:
+                    progress(n_done, time.perf_counter() - start)
+                yield from results
+        finally:
+            _classify_typer = None
+
+    def classify(
+        self,
+        names: Iterable[str],
+        workers: Optional[int] = None,
+        chunk_size: int = 10_000,
+        progress: Optional[Callable[[int, float], None]] = None,
+    ) -> list[bool]:
+        """
+        Classify names as individuals or not, using multiple processes.
+
+        Parameters
+        ----------
+            names (Iterable[str]): The names to classify.
+            workers (Optional[int]): The number of worker processes. Defaults to the number of CPUs.
+            chunk_size (int): The number of names sent to a worker at a time.
+            progress (Optional[Callable[[int, float], None]]): Called after each chunk with the number of names
+                classified so far and the elapsed time in seconds.
+
+        Returns
+        -------
+            list[bool]: Whether each name is an individual, in input order.
+        """
+        return list(self.iter_classify(names, workers=workers, chunk_size=chunk_size, progress=progress))
+
+
+def _init_classify_worker():
+    global _classify_typer
+    _classify_typer = NameTyper()
+
+
+def _classify_chunk(names: list[str]) -> list[bool]:
+    return [_classify_typer.is_individual(name) for name in names]
+
 
 if __name__ == "__main__":
     typer = NameTyper()
@@ -0,0 +1,54 @@
+import gc
+import multiprocessing
+from collections import deque
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def imap_bounded(
+    function: Callable[[T], R],
+    items: Iterable[T],
+    workers: int,
+    initializer: Optional[Callable[[], None]] = None,
+) -> Iterator[R]:
+    """
+    Lazily map a function over items on a pool of worker processes, yielding the results in input order.
+
+    The items are consumed as results are yielded, with at most two items in flight per worker, so arbitrarily
+    long iterables are streamed with bounded memory.
+
+    Workers are forked where possible, so they share whatever the parent has loaded (lexicons, indexes)
+    copy-on-write. Freezing the GC keeps the collector from touching (and therefore copying) every page of it
+    in each child. Elsewhere they are spawned, and run `initializer` to load what they need.
+
+    Parameters
+    ----------
+        function (Callable[[T], R]): The function, which must be picklable (e.g. defined at module level).
+        items (Iterable[T]): The items to map it over, e.g. chunks of a larger input.
+        workers (int): The number of worker processes.
+        initializer (Optional[Callable[[], None]]): Run in each spawned worker before it takes any items.
+
+    Yields
+    ------
+        R: The result for each item.
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        gc.freeze()
+        pool = multiprocessing.get_context("fork").Pool(workers)
+    else:
+        pool = multiprocessing.get_context().Pool(workers, initializer=initializer)
+
+    try:
+        in_flight = deque()
+        for item in items:
+            in_flight.append(pool.apply_async(function, (item,)))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+        gc.unfreeze()
@@ -1,3 +1,3 @@
-from .match_school import match_string_to_school_id
+from .match_school import match_string_to_school_id, match_strings_to_school_ids
 
-__all__ = ["match_string_to_school_id"]
+__all__ = ["match_string_to_school_id", "match_strings_to_school_ids"]
@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Any, Optional
+
+import numpy as np
+
+from donoratlas.schools.index import BASE_DIR, get_index
+from donoratlas.schools.match_school import MatchStats, match_string_to_school_id, match_strings_to_school_ids
+
+BENCHMARK_PATH = os.path.join(BASE_DIR, "static", "school_benchmark.jsonl")
+
+
+def load_samples(path: str = BENCHMARK_PATH) -> list[dict[str, Any]]:
+    """
+    Load a labeled sample of education strings.
+
+    Parameters
+    ----------
+        path (str): A JSONL file with a "query" and a list of acceptable "wd_ids" (empty if the query should not
+            match any school) on each line.
+
+    Returns
+    -------
+        list[dict[str, Any]]: The samples.
+    """
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def _result_ids(result: Any) -> list[str]:
+    if result is None:
+        return []
+    if isinstance(result, str):
+        return [result]
+    return list(result)
+
+
+def _is_correct(result: Any, wd_ids: list[str]) -> bool:
+    ids = _result_ids(result)
+    return ids == [] if not wd_ids else len(ids) == 1 and ids[0] in wd_ids
+
+
+def run_benchmark(samples: list[dict[str, Any]], repeat: int = 1, batch: bool = False) -> dict[str, Any]:
+    """
+    Match a labeled sample and measure accuracy and speed.
+
+    Samples labeled with schools missing from the schools index can't be matched, so they are dropped (and
+    counted in the report).
+
+    Parameters
+    ----------
+        samples (list[dict[str, Any]]): The samples, as loaded by `load_samples`.
+        repeat (int): The number of times to match the sample, for steadier timings.
+        batch (bool): Whether to also time `match_strings_to_school_ids` on the whole sample.
+
+    Returns
+    -------
+        dict[str, Any]: The number of samples matched and dropped, accuracy (a single correct id, or no match when
+            none is expected), ambiguous (the correct id among several), queries per second, latency percentiles in
+            milliseconds, total seconds per stage, and each sample's result.
+    """
+    records = get_index().records
+    n_samples = len(samples)
+    samples = [sample for sample in samples if all(wd_id in records for wd_id in sample["wd_ids"])]
+
+    latencies = []
+    stage_seconds: dict[str, float] = defaultdict(float)
+    results = []
+    for i in range(repeat):
+        for sample in samples:
+            stats = MatchStats()
+            start = time.perf_counter()
+            result = match_string_to_school_id(sample["query"], stats=stats)
+            latencies.append(time.perf_counter() - start)
+            for stage, seconds in stats.stage_seconds.items():
+                stage_seconds[stage] += seconds
+            if i == 0:
+                results.append(
+                    {
+                        "query": sample["query"],
+                        "expected": sample["wd_ids"],
+                        "result": _result_ids(result),
+                        "correct": _is_correct(result, sample["wd_ids"]),
+                    }
+                )
+
+    latencies_ms = np.array(latencies) * 1000
+    n_correct = sum(result["correct"] for result in results)
+    n_ambiguous = sum(
+        not result["correct"] and any(wd_id in result["result"] for wd_id in result["expected"])
+        for result in results
+    )
+    report: dict[str, Any] = {
+        "samples": len(samples),
+        "dropped": n_samples - len(samples),
+        "accuracy": n_correct / len(samples) if samples else 0.0,
+        "ambiguous": n_ambiguous / len(samples) if samples else 0.0,
+        "qps": len(latencies) / latencies_ms.sum() * 1000 if len(latencies) else 0.0,
+        "latency_ms": {
+            f"p{p}": float(np.percentile(latencies_ms, p)) if len(latencies) else 0.0 for p in (50, 95, 99)
+        },
+        "stage_seconds": {stage: seconds / repeat for stage, seconds in stage_seconds.items()},
+        "results": results,
+    }
+
+    if batch:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            match_strings_to_school_ids([sample["query"] for sample in samples])
+        report["batch_qps"] = len(samples) * repeat / (time.perf_counter() - start)
+    return report
+
+
+def compare_reports(report: dict[str, Any], baseline: dict[str, Any]) -> list[str]:
+    """
+    Find the samples a baseline report got right which a new report gets wrong.
+
+    Parameters
+    ----------
+        report (dict[str, Any]): The new report.
+        baseline (dict[str, Any]): The baseline report.
+
+    Returns
+    -------
+        list[str]: The queries which regressed.
+    """
+    baseline_correct = {result["query"] for result in baseline["results"] if result["correct"]}
+    return [
+        result["query"]
+        for result in report["results"]
+        if result["query"] in baseline_correct and not result["correct"]
+    ]
+
+
+def print_report(report: dict[str, Any], regressions: Optional[list[str]] = None):
+    dropped = f" ({report['dropped']} dropped: labeled with schools missing from the index)"
+    print(f"samples:    {report['samples']}{dropped if report.get('dropped') else ''}")
+    print(f"accuracy:   {report['accuracy']:.1%} (ambiguous: {report['ambiguous']:.1%})")
+    print(f"throughput: {report['qps']:,.1f} queries/s")
+    if "batch_qps" in report:
+        print(f"batch:      {report['batch_qps']:,.1f} queries/s")
+    latency = report["latency_ms"]
+    print(f"latency:    p50 {latency['p50']:.2f}ms, p95 {latency['p95']:.2f}ms, p99 {latency['p99']:.2f}ms")
+    for stage, seconds in sorted(report["stage_seconds"].items(), key=lambda item: -item[1]):
+        print(f"  {stage:<12}{seconds * 1000:10.1f}ms")
+    for result in report["results"]:
+        if not result["correct"]:
+            print(f"  wrong: {result['query']!r} -> {result['result']} (expected {result['expected']})")
+    if regressions is not None:
+        print(f"regressions: {len(regressions)}")
+        for query in regressions:
+            print(f"  {query!r}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark school matching on a labeled sample.")
+    parser.add_argument("--samples", default=BENCHMARK_PATH, help="The labeled sample (JSONL).")
+    parser.add_argument("--repeat", type=int, default=1, help="How many times to match the sample.")
+    parser.add_argument("--batch", action="store_true", help="Also time the batch matcher.")
+    parser.add_argument("--output", help="Write the report to this JSON file.")
+    parser.add_argument("--baseline", help="A report to check for regressions against; exits 1 if any.")
+    args = parser.parse_args()
+
+    # Load the index up front, so it doesn't count towards the first query's latency
+    get_index()
+    report = run_benchmark(load_samples(args.samples), repeat=args.repeat, batch=args.batch)
+
+    regressions = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare_reports(report, json.load(file))
+    print_report(report, regressions)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    if regressions:
+        raise SystemExit(1)
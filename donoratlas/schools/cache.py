@@ -0,0 +1,133 @@
+import os
+import pickle
+import sqlite3
+from typing import Any, Optional
+
+from donoratlas.schools.index import get_index
+
+# In the user's cache directory rather than the package, which may be installed read-only
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "donoratlas"
+)
+MATCH_CACHE_PATH = os.path.join(CACHE_DIR, "school_match_cache.sqlite")
+
+
+class MatchCache:
+    """
+    A persistent cache of school match results, stored in a SQLite file.
+
+    Results are keyed by the preprocessed query and the version of the schools index they were matched against,
+    so rebuilding or updating the index invalidates them. Entries for other index versions are deleted when the
+    cache is opened.
+
+    Attributes
+    ----------
+        path (str): The path to the SQLite file, by default in `$XDG_CACHE_HOME/donoratlas` (or
+            `~/.cache/donoratlas`). Its directory is created if needed.
+        hits (int): The number of lookups that found a cached result since the cache was opened.
+        misses (int): The number of lookups that did not.
+    """
+
+    def __init__(self, path: str = MATCH_CACHE_PATH, index_version: Optional[str] = None):
+        self.path = path
+        self._index_version = index_version
+        self.hits = 0
+        self.misses = 0
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS matches "
+            "(query TEXT NOT NULL, index_version TEXT NOT NULL, result BLOB NOT NULL, "
+            "PRIMARY KEY (query, index_version))"
+        )
+        self._connection.execute("DELETE FROM matches WHERE index_version != ?", (self.index_version,))
+        self._connection.commit()
+
+    @property
+    def index_version(self) -> str:
+        """
+        The version of the schools index that results are cached for: the one given, or else the current one.
+        """
+        return get_index().version if self._index_version is None else self._index_version
+
+    def get(self, query: str) -> tuple[bool, Any]:
+        """
+        Look up the cached result for a preprocessed query.
+
+        Parameters
+        ----------
+            query (str): The query, as output by `preprocess_query`.
+
+        Returns
+        -------
+            tuple[bool, Any]: Whether there was a cached result, and the result (None if there was not).
+        """
+        row = self._connection.execute(
+            "SELECT result FROM matches WHERE query = ? AND index_version = ?", (query, self.index_version)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, pickle.loads(row[0])
+
+    def set(self, query: str, result: Any):
+        """
+        Cache the result for a preprocessed query.
+
+        Parameters
+        ----------
+            query (str): The query, as output by `preprocess_query`.
+            result (Any): The result of matching it.
+        """
+        self.set_many([(query, result)])
+
+    def set_many(self, items: list[tuple[str, Any]]):
+        """
+        Cache the results for many preprocessed queries in one transaction.
+
+        Parameters
+        ----------
+            items (list[tuple[str, Any]]): The queries, as output by `preprocess_query`, and their results.
+        """
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO matches (query, index_version, result) VALUES (?, ?, ?)",
+                [
+                    (query, self.index_version, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+                    for query, result in items
+                ],
+            )
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        The fraction of lookups since the cache was opened that found a cached result (0 if there were none).
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Get the cache's hit-rate metrics and size.
+        """
+        (size,) = self._connection.execute("SELECT COUNT(*) FROM matches").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "size": size}
+
+    def clear(self):
+        """
+        Delete every cached result.
+        """
+        with self._connection:
+            self._connection.execute("DELETE FROM matches")
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self) -> "MatchCache":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,25 +1,67 @@
+import argparse
 import ast
+import csv
+import json
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Iterable, Iterator, Optional
+from urllib.parse import urlsplit, urlunsplit
+
 import requests
 from bs4 import BeautifulSoup
-import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "DonorAtlas school summary fetcher (https://github.com/DonorAtlas/DonorAtlas)"
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_RETRIES = 5
+DEFAULT_WORKERS = 8
 
-def scrape_wikipedia_summary(url):
+OUTPUT_FIELDS = ["wd_id", "url", "summary"]
+
+
+def make_session(pool_size: int = DEFAULT_WORKERS, retries: int = DEFAULT_RETRIES) -> requests.Session:
     """
-    Scrapes the main content of a Wikipedia page and creates a 5-6 sentence summary.
-    
+    Make a session whose connections are pooled and reused across threads, and which retries failed requests
+    (connection errors, 429s and 5xx responses) with exponential backoff, respecting Retry-After.
+
     Args:
-        url (str): URL of the Wikipedia page.
-    
+        pool_size (int): The number of connections kept open per host.
+        retries (int): The number of times to retry a request.
+
     Returns:
-        str: A concise summary of the page.
+        requests.Session: The session.
     """
-    # Request the page content
-    response = requests.get(url)
-    response.raise_for_status()
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+def summarize_html(html: str) -> str:
+    """
+    Creates a 5-6 sentence summary from the main content of a Wikipedia page.
+
+    Args:
+        html (str): The HTML of the Wikipedia page.
 
+    Returns:
+        str: A concise summary of the page.
+    """
     # Parse the HTML content
-    soup = BeautifulSoup(response.text, 'html.parser')
+    soup = BeautifulSoup(html, "html.parser")
 
     # Find the main content (first few paragraphs)
     paragraphs = soup.select("div.mw-parser-output > p")
@@ -40,24 +82,210 @@ def scrape_wikipedia_summary(url):
     return summary
 
 
-if __name__ == '__main__':
-    wiki_urls = []
+def scrape_wikipedia_summary(
+    url: str, session: Optional[requests.Session] = None, timeout: float = DEFAULT_TIMEOUT
+) -> str:
+    """
+    Scrapes the main content of a Wikipedia page and creates a 5-6 sentence summary.
+
+    Args:
+        url (str): URL of the Wikipedia page.
+        session (Optional[requests.Session]): The session to fetch the page with. Defaults to a new one.
+        timeout (float): The connect and read timeout, in seconds.
+
+    Returns:
+        str: A concise summary of the page.
+    """
+    session = make_session(pool_size=1) if session is None else session
+    # Request the page content
+    response = session.get(url, timeout=timeout)
+    response.raise_for_status()
+    return summarize_html(response.text)
+
+
+def read_wiki_entities(path: str) -> Iterator[dict[str, str]]:
+    """
+    Read the wd_id and Wikipedia URL of each entity in a file of Python dict literals, one per line.
 
-    with open('raw_wiki_entities_1733427824.841352.txt', 'r') as file:
-        for i, line in enumerate(file):
+    Args:
+        path (str): The path to the file.
+
+    Yields:
+        dict[str, str]: The "wd_id" and "url" of each entity which has both. Malformed lines are skipped.
+    """
+    with open(path, "r") as file:
+        for line in file:
             try:
                 # Parse the line as a Python dictionary using ast.literal_eval
                 record = ast.literal_eval(line.strip())
-
-                # Ensure the record contains the required keys
-                if 'wd_id' in record and 'wikipediaURL' in record:
-                    wiki_urls.append({'wd_id': record['wd_id'], 'url': record['wikipediaURL']})
-            except (ValueError, SyntaxError) as e:  # Handle malformed lines
+            except (ValueError, SyntaxError):  # Handle malformed lines
                 continue
 
-    with open('wiki_summaries.csv', 'w') as file:
-        for url in wiki_urls:
-            summary = scrape_wikipedia_summary(url['url'])
-            print("Wikipedia Summary:")
-            print(summary)
-            file.write(f"{url['wd_id']},{url['url']},'{summary}'\n")
+            # Ensure the record contains the required keys
+            if isinstance(record, dict) and record.get("wd_id") and record.get("wikipediaURL"):
+                yield {"wd_id": record["wd_id"], "url": record["wikipediaURL"]}
+
+
+def read_checkpoint(path: str) -> set[str]:
+    """
+    Read the wd_ids already fetched, from a checkpoint file written by `fetch_summaries`.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r", encoding="utf-8") as file:
+        return {line.strip() for line in file if line.strip()}
+
+
+def rebase_url(url: str, base_url: str) -> str:
+    """
+    Point a URL at another server, keeping its path and query (e.g. to fetch from a local mirror).
+    """
+    base = urlsplit(base_url)
+    parts = urlsplit(url)
+    return urlunsplit((base.scheme, base.netloc, base.path.rstrip("/") + parts.path, parts.query, ""))
+
+
+class _SummaryWriter:
+    """
+    Appends summaries to a CSV or JSONL file, then records their wd_ids in the checkpoint file.
+    """
+
+    def __init__(self, output_path: str, checkpoint_path: str, output_format: str):
+        new_file = not os.path.exists(output_path) or os.path.getsize(output_path) == 0
+        self.output_format = output_format
+        self._output = open(output_path, "a", encoding="utf-8", newline="")
+        self._checkpoint = open(checkpoint_path, "a", encoding="utf-8")
+        self._csv = csv.DictWriter(self._output, fieldnames=OUTPUT_FIELDS) if output_format == "csv" else None
+        if self._csv is not None and new_file:
+            self._csv.writeheader()
+
+    def write(self, row: dict[str, str]):
+        if self._csv is not None:
+            self._csv.writerow(row)
+        else:
+            self._output.write(json.dumps(row, ensure_ascii=False) + "\n")
+        # The summary is flushed before the checkpoint, so a crash can repeat a row but never lose one
+        self._output.flush()
+        self._checkpoint.write(row["wd_id"] + "\n")
+        self._checkpoint.flush()
+
+    def close(self):
+        self._output.close()
+        self._checkpoint.close()
+
+
+def fetch_summaries(
+    entities: Iterable[dict[str, str]],
+    output_path: str,
+    checkpoint_path: Optional[str] = None,
+    output_format: Optional[str] = None,
+    workers: int = DEFAULT_WORKERS,
+    timeout: float = DEFAULT_TIMEOUT,
+    retries: int = DEFAULT_RETRIES,
+    base_url: Optional[str] = None,
+) -> dict[str, int]:
+    """
+    Fetch the Wikipedia summary of many entities concurrently, appending them to a CSV or JSONL file.
+
+    Entities whose wd_id is in the checkpoint file are skipped, so an interrupted run picks up where it left off.
+    Failed requests are retried with backoff; entities which still fail are logged and left out of the
+    checkpoint, so that the next run tries them again.
+
+    Args:
+        entities (Iterable[dict[str, str]]): The "wd_id" and "url" of each entity, e.g. from `read_wiki_entities`.
+        output_path (str): The file to append the wd_id, URL and summary of each entity to.
+        checkpoint_path (Optional[str]): The file recording which wd_ids are done. Defaults to `output_path` with
+            ".done" appended.
+        output_format (Optional[str]): "csv" or "jsonl". Defaults to the extension of `output_path`.
+        workers (int): The number of requests in flight at once.
+        timeout (float): The connect and read timeout of each request, in seconds.
+        retries (int): The number of times to retry each request.
+        base_url (Optional[str]): If given, fetch from this server instead of the one in each URL.
+
+    Returns:
+        dict[str, int]: The number of entities fetched, skipped (already done) and failed.
+    """
+    checkpoint_path = f"{output_path}.done" if checkpoint_path is None else checkpoint_path
+    if output_format is None:
+        output_format = "jsonl" if output_path.endswith((".jsonl", ".json")) else "csv"
+    if output_format not in ("csv", "jsonl"):
+        raise ValueError(f"Unknown output format {output_format!r}")
+
+    done = read_checkpoint(checkpoint_path)
+    counts = {"fetched": 0, "skipped": 0, "failed": 0}
+    session = make_session(pool_size=workers, retries=retries)
+    writer = _SummaryWriter(output_path, checkpoint_path, output_format)
+
+    def fetch(entity: dict[str, str]) -> dict[str, str]:
+        url = entity["url"] if base_url is None else rebase_url(entity["url"], base_url)
+        return {**entity, "summary": scrape_wikipedia_summary(url, session=session, timeout=timeout)}
+
+    # Results are collected on this thread, so writes and counts need no locking
+    def collect(future: Future, entity: dict[str, str]):
+        try:
+            row = future.result()
+        except Exception as e:
+            logger.warning("Failed to fetch %s (%s): %s", entity["wd_id"], entity["url"], e)
+            counts["failed"] += 1
+            return
+        writer.write(row)
+        counts["fetched"] += 1
+        if counts["fetched"] % 100 == 0:
+            logger.info("Fetched %d summaries (%d failed)", counts["fetched"], counts["failed"])
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Keep a bounded number of requests in flight, so huge inputs aren't all queued up front
+            in_flight: dict[Future, dict[str, str]] = {}
+            for entity in entities:
+                if entity["wd_id"] in done:
+                    counts["skipped"] += 1
+                    continue
+                done.add(entity["wd_id"])
+                in_flight[executor.submit(fetch, entity)] = entity
+                if len(in_flight) >= workers * 2:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        collect(future, in_flight.pop(future))
+            for future in list(in_flight):
+                collect(future, in_flight.pop(future))
+    finally:
+        writer.close()
+        session.close()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch Wikipedia summaries of schools.")
+    parser.add_argument(
+        "--input",
+        default="raw_wiki_entities_1733427824.841352.txt",
+        help="A file of entity dicts (with wd_id and wikipediaURL), one per line.",
+    )
+    parser.add_argument(
+        "--output", default="wiki_summaries.csv", help="The .csv or .jsonl file to append to."
+    )
+    parser.add_argument(
+        "--checkpoint", default=None, help="The file of completed wd_ids (default: OUTPUT.done)."
+    )
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Concurrent requests.")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="Request timeout in seconds.")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="Retries per request.")
+    parser.add_argument(
+        "--base-url", default=None, help="Fetch from this server instead (e.g. a local mirror)."
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    counts = fetch_summaries(
+        read_wiki_entities(args.input),
+        args.output,
+        checkpoint_path=args.checkpoint,
+        workers=args.workers,
+        timeout=args.timeout,
+        retries=args.retries,
+        base_url=args.base_url,
+    )
+    logger.info(
+        "Done: %d fetched, %d already done, %d failed", counts["fetched"], counts["skipped"], counts["failed"]
+    )
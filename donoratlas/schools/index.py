@@ -0,0 +1,689 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import pickle
+import re
+from collections import defaultdict
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHOOLS_CSV_PATH = os.path.join(BASE_DIR, "static", "schools.csv")
+SCHOOLS_INDEX_PATH = os.path.join(BASE_DIR, "static", "schools_index.pkl")
+SCHOOLS_DELTA_PATH = os.path.join(BASE_DIR, "static", "schools_delta.json")
+
+# Bump whenever the structure of SchoolsIndex changes, so that stale index files are rebuilt
+INDEX_FORMAT_VERSION = 6
+
+CATEGORIES = ["law", "business", "medical", "engineer", "high school"]
+
+# How many candidate names the prefilter keeps for fuzzy scoring
+PREFILTER_LIMIT = 300
+
+# Words which don't count towards the important-word coverage in custom_scoring_function
+SCORING_IGNORE_WORDS = frozenset(
+    {
+        "school",
+        "college",
+        "university",
+        "state",
+        "law",
+        "business",
+        "medical",
+        "of",
+        "the",
+        "program",
+        "junior",
+        "senior",
+        "high",
+    }
+)
+
+
+def file_hash(path: str) -> str:
+    """
+    Get the SHA-256 hash of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def school_keys(name: str, alt_labels: Any = None) -> list[str]:
+    """
+    Get the lowercased name and nicknames a school is matched on.
+
+    Parameters
+    ----------
+        name (str): The school's name.
+        alt_labels (Any): Its nicknames, as a JSON list (the altLabels column of schools.csv) or a list. Anything
+            else (e.g. NaN for a missing altLabels) means no nicknames.
+
+    Returns
+    -------
+        list[str]: The name, then the nicknames.
+    """
+    keys = [name.encode("utf-8").decode("unicode_escape").strip().lower()]
+    if isinstance(alt_labels, str):
+        alt_labels = json.loads(alt_labels)
+    if isinstance(alt_labels, list):
+        keys.extend(
+            nickname.encode("utf-8").decode("unicode_escape").strip().strip("'").strip('"').lower()
+            for nickname in alt_labels
+            if nickname.strip()
+        )
+    return keys
+
+
+def school_categories(instance_of: str) -> list[str]:
+    """
+    Get the categories of a school from the instance of column of schools.csv.
+    """
+    return [category for category in CATEGORIES if category in instance_of]
+
+
+def name_tokens(name: str) -> list[str]:
+    """
+    Split a school name into casefolded word tokens, ignoring punctuation.
+    """
+    return re.findall(r"\w+", name.casefold())
+
+
+def name_trigrams(tokens: list[str]) -> set[str]:
+    """
+    Get the character trigrams of a tokenized name, ignoring spaces and punctuation (so "M.I.T." has "mit").
+    """
+    compact = "".join(tokens)
+    return {compact[i : i + 3] for i in range(len(compact) - 2)}
+
+
+# Words left out of acronyms ("Massachusetts Institute of Technology" is "MIT")
+ACRONYM_STOP_WORDS = frozenset({"of", "the", "at", "and", "for", "in", "on"})
+
+# What separates a name from its campus ("University of California, Los Angeles")
+_QUALIFIER_RE = re.compile(r",\s*|\s+(?:at|in|-|–|—)\s+")
+
+
+def short_forms(name: str) -> set[str]:
+    """
+    Get the acronyms and short forms a school name is likely to be written as.
+
+    These are the initials of the name ("University of California, Los Angeles" is "ucla"), and, for names with a
+    campus, the initials of the rest alone and followed by the campus ("uc" and "uc los angeles"). Acronyms of
+    fewer than three letters are too ambiguous to use on their own.
+
+    Parameters
+    ----------
+        name (str): The school name.
+
+    Returns
+    -------
+        set[str]: The lowercased short forms.
+    """
+
+    def initials(words: list[str]) -> str:
+        return "".join(word[0] for word in words if word not in ACRONYM_STOP_WORDS)
+
+    forms = set()
+    tokens = name_tokens(name)
+    if len(initials(tokens)) >= 3:
+        forms.add(initials(tokens))
+
+    parts = _QUALIFIER_RE.split(name.casefold(), maxsplit=1)
+    if len(parts) == 2:
+        main, qualifier = name_tokens(parts[0]), name_tokens(parts[1])
+        if len(initials(main)) >= 2 and qualifier:
+            forms.add(f"{initials(main)} {' '.join(qualifier)}")
+            if len(initials(main)) >= 3:
+                forms.add(initials(main))
+    # A one-word name is its own short form, and the exact lookup already has it
+    forms.discard(name.casefold())
+    return forms
+
+
+def normalize_text(s: str) -> str:
+    """
+    Lowercase, strip, and remove parentheses, as custom_scoring_function compares names.
+    """
+    return re.sub(r"\(.*?\)", "", s.lower().strip()).strip().lower()
+
+
+class NameFeatures:
+    """
+    The parts of each name that custom_scoring_function uses, computed once so that scoring doesn't have to.
+
+    Attributes
+    ----------
+        normalized (list[str]): The normalized text of each name.
+        words (list[frozenset[str]]): The set of words in each normalized name.
+        important_words (list[frozenset[str]]): The same, without `SCORING_IGNORE_WORDS`.
+        word_counts (np.ndarray): The number of distinct words in each normalized name.
+    """
+
+    def __init__(self, names: list[str]):
+        self.normalized = [normalize_text(name) for name in names]
+        self.words = [frozenset(name.split()) for name in self.normalized]
+        self.important_words = [words - SCORING_IGNORE_WORDS for words in self.words]
+        self.word_counts = np.array([len(words) for words in self.words], dtype=np.int64)
+
+    def add(self, name: str):
+        """
+        Add the features of a name to the end.
+        """
+        normalized = normalize_text(name)
+        words = frozenset(normalized.split())
+        self.normalized.append(normalized)
+        self.words.append(words)
+        self.important_words.append(words - SCORING_IGNORE_WORDS)
+        self.word_counts = np.append(self.word_counts, len(words))
+
+
+class CandidatePrefilter:
+    """
+    An inverted index from word tokens and character trigrams to the names containing them.
+
+    It narrows a query down to the few hundred names sharing the most (IDF-weighted) tokens and trigrams with it,
+    so that only those need to be fuzzy-scored. This is a heuristic: WRatio can score a name above the match cutoff
+    without it sharing any token or trigram with the query, so the prefilter can miss matches and is only used
+    when asked for.
+
+    Attributes
+    ----------
+        size (int): The number of names indexed.
+        token_postings (dict[str, np.ndarray]): The indices of the names containing each token.
+        trigram_postings (dict[str, np.ndarray]): The indices of the names containing each trigram.
+    """
+
+    def __init__(self, names: list[str]):
+        self.size = len(names)
+        token_postings: dict[str, list[int]] = defaultdict(list)
+        trigram_postings: dict[str, list[int]] = defaultdict(list)
+        for i, name in enumerate(names):
+            tokens = name_tokens(name)
+            for token in set(tokens):
+                token_postings[token].append(i)
+            for trigram in name_trigrams(tokens):
+                trigram_postings[trigram].append(i)
+
+        self.token_postings = {token: np.array(idx, dtype=np.int32) for token, idx in token_postings.items()}
+        self.trigram_postings = {
+            trigram: np.array(idx, dtype=np.int32) for trigram, idx in trigram_postings.items()
+        }
+
+    def add(self, position: int, name: str):
+        """
+        Index a name at a position after all the names indexed so far.
+        """
+        self.size = max(self.size, position + 1)
+        tokens = name_tokens(name)
+        for postings, keys in (
+            (self.token_postings, set(tokens)),
+            (self.trigram_postings, name_trigrams(tokens)),
+        ):
+            for key in keys:
+                postings[key] = np.append(postings.get(key, np.empty(0, dtype=np.int32)), np.int32(position))
+
+    def remove(self, position: int, name: str):
+        """
+        Stop returning the name at a position as a candidate.
+        """
+        tokens = name_tokens(name)
+        for postings, keys in (
+            (self.token_postings, set(tokens)),
+            (self.trigram_postings, name_trigrams(tokens)),
+        ):
+            for key in keys:
+                remaining = postings[key][postings[key] != position]
+                if len(remaining):
+                    postings[key] = remaining
+                else:
+                    del postings[key]
+
+    def _idf(self, postings: np.ndarray) -> float:
+        return math.log(1 + self.size / len(postings))
+
+    def candidates(
+        self, query: str, limit: int = PREFILTER_LIMIT, mask: Optional[np.ndarray] = None
+    ) -> Optional[np.ndarray]:
+        """
+        Find the names most likely to fuzzy-match a query.
+
+        Parameters
+        ----------
+            query (str): The query.
+            limit (int): The maximum number of candidates.
+            mask (Optional[np.ndarray]): A boolean array over the names; only names where it is True are returned.
+
+        Returns
+        -------
+            Optional[np.ndarray]: The indices of the candidate names, in ascending order. None if the query is too
+                short to prefilter, in which case every name should be considered.
+        """
+        tokens = name_tokens(query)
+        trigrams = name_trigrams(tokens)
+        if not trigrams:
+            return None
+
+        scores = np.zeros(self.size, dtype=np.float32)
+        # Postings hold each name at most once, so the fancy-indexed adds never collide
+        for trigram in trigrams:
+            postings = self.trigram_postings.get(trigram)
+            if postings is not None:
+                scores[postings] += self._idf(postings)
+        for token in set(tokens):
+            postings = self.token_postings.get(token)
+            if postings is not None:
+                scores[postings] += 2 * self._idf(postings)
+        if mask is not None:
+            scores[~mask] = 0
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > limit:
+            matched = matched[np.argpartition(-scores[matched], limit - 1)[:limit]]
+        return np.sort(matched)
+
+
+class SchoolsIndex:
+    """
+    Everything the school matcher needs from schools.csv, precompiled so it can be loaded quickly.
+
+    Schools can be added, updated and removed in place with `add_school`, `update_school` and `remove_school`,
+    which keep every structure below consistent. Names no longer used by any school stay in `names` (so positions
+    don't shift), but are dropped from every other structure. The changes are recorded in `delta`, which can be
+    saved with `save_delta` and applied to a freshly built index with `apply_delta`.
+
+    Attributes
+    ----------
+        source_hash (str): The SHA-256 hash of the CSV the index was built from.
+        source_stat (tuple[int, int]): The size and modification time of that CSV, to skip hashing when unchanged.
+        string_id_map (dict[str, list[str]]): Mapping from any (lowercased) school name or nickname to school ids.
+        category_maps (dict[str, dict[str, list[str]]]): The same mapping, restricted to each of `CATEGORIES`.
+        columns (list[str]): The columns of schools.csv.
+        records (dict[str, tuple]): Mapping from school id to its row of schools.csv (in `columns` order).
+        names (list[str]): Every key of `string_id_map`, in order.
+        name_positions (dict[str, int]): The position of each name in `names`.
+        category_masks (dict[str, np.ndarray]): For each category, whether each of `names` is in that category.
+        prefilter (CandidatePrefilter): Token and trigram index over `names`.
+        features (NameFeatures): The scoring features of `names`.
+        short_form_map (dict[str, list[str]]): Mapping from the acronyms and short forms of `names` (see
+            `short_forms`) to school ids.
+        delta (list[dict[str, Any]]): The changes made since the index was built from the CSV.
+    """
+
+    def __init__(
+        self,
+        source_hash: str,
+        source_stat: tuple[int, int],
+        string_id_map: dict[str, list[str]],
+        category_maps: dict[str, dict[str, list[str]]],
+        columns: list[str],
+        records: dict[str, tuple],
+    ):
+        self.source_hash = source_hash
+        self.source_stat = source_stat
+        self.string_id_map = string_id_map
+        self.category_maps = category_maps
+        self.columns = columns
+        self.records = records
+        self._dataframe: Optional[pd.DataFrame] = None
+
+        self.names = list(string_id_map)
+        self.name_positions = {name: i for i, name in enumerate(self.names)}
+        self.category_masks = {
+            category: np.array([name in category_map for name in self.names], dtype=bool)
+            for category, category_map in category_maps.items()
+        }
+        self.prefilter = CandidatePrefilter(self.names)
+        self.features = NameFeatures(self.names)
+
+        self.short_form_map: dict[str, list[str]] = {}
+        # The names each school is matched on, to remove them with the school
+        self._keys_by_id: dict[str, set[str]] = defaultdict(set)
+        for name, ids in string_id_map.items():
+            forms = short_forms(name)
+            for wd_id in ids:
+                self._keys_by_id[wd_id].add(name)
+                for form in forms:
+                    self._add_id(self.short_form_map, form, wd_id)
+        self.delta: list[dict[str, Any]] = []
+        self._version: Optional[str] = None
+
+    @property
+    def version(self) -> str:
+        """
+        An identifier which changes whenever the contents of the index change.
+        """
+        if self._version is None:
+            self._version = f"{INDEX_FORMAT_VERSION}-{self.source_hash[:16]}"
+            if self.delta:
+                delta_hash = hashlib.sha256(json.dumps(self.delta, sort_keys=True).encode()).hexdigest()
+                self._version = f"{self._version}-{delta_hash[:16]}"
+        return self._version
+
+    @property
+    def dataframe(self) -> pd.DataFrame:
+        """
+        The schools as a DataFrame, in the same shape as schools.csv. Built on first access.
+        """
+        if self._dataframe is None:
+            self._dataframe = pd.DataFrame(list(self.records.values()), columns=self.columns)
+        return self._dataframe
+
+    def __getstate__(self) -> dict[str, Any]:
+        return {**self.__dict__, "_dataframe": None}
+
+    def add_school(
+        self,
+        wd_id: str,
+        name: str,
+        alt_labels: Optional[list[str]] = None,
+        instance_of: str = "",
+        **fields: Any,
+    ):
+        """
+        Add a school.
+
+        Parameters
+        ----------
+            wd_id (str): The school's id.
+            name (str): The school's name.
+            alt_labels (Optional[list[str]]): Its nicknames.
+            instance_of (str): What it is an instance of, as in schools.csv (e.g. "['law school']"), which decides
+                its categories.
+            **fields (Any): Values for the other columns of schools.csv.
+
+        Raises
+        ------
+            ValueError: If there is already a school with the id, or a field isn't a column of schools.csv.
+        """
+        if wd_id in self.records:
+            raise ValueError(f"School {wd_id} already exists; use update_school")
+        self._set_school(wd_id, {"name": name, "altLabels": alt_labels, "instance of": instance_of, **fields})
+
+    def update_school(
+        self,
+        wd_id: str,
+        name: Optional[str] = None,
+        alt_labels: Optional[list[str]] = None,
+        instance_of: Optional[str] = None,
+        **fields: Any,
+    ):
+        """
+        Update a school. Arguments left as None keep their current values.
+
+        Parameters
+        ----------
+            wd_id (str): The school's id.
+            name (Optional[str]): The school's new name.
+            alt_labels (Optional[list[str]]): Its new nicknames.
+            instance_of (Optional[str]): What it is now an instance of.
+            **fields (Any): New values for the other columns of schools.csv.
+
+        Raises
+        ------
+            KeyError: If there is no school with the id.
+            ValueError: If a field isn't a column of schools.csv.
+        """
+        if wd_id not in self.records:
+            raise KeyError(wd_id)
+        updates = {"name": name, "altLabels": alt_labels, "instance of": instance_of, **fields}
+        self._set_school(wd_id, {column: value for column, value in updates.items() if value is not None})
+
+    def remove_school(self, wd_id: str):
+        """
+        Remove a school.
+
+        Parameters
+        ----------
+            wd_id (str): The school's id.
+
+        Raises
+        ------
+            KeyError: If there is no school with the id.
+        """
+        if wd_id not in self.records:
+            raise KeyError(wd_id)
+        self._unindex_school(wd_id)
+        del self.records[wd_id]
+        self._dataframe = None
+        self.delta.append({"op": "remove", "wd_id": wd_id})
+        self._version = None
+
+    def apply_delta(self, delta: list[dict[str, Any]]):
+        """
+        Apply changes recorded in another index's `delta`.
+        """
+        for change in delta:
+            if change["op"] == "remove":
+                if change["wd_id"] in self.records:
+                    self.remove_school(change["wd_id"])
+            else:
+                self._set_school(change["wd_id"], change["fields"])
+
+    def save_delta(self, delta_path: str = SCHOOLS_DELTA_PATH):
+        """
+        Write the changes made since the index was built to a JSON file.
+        """
+        tmp_path = f"{delta_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self.delta, file, indent=2)
+        os.replace(tmp_path, delta_path)
+
+    def _set_school(self, wd_id: str, fields: dict[str, Any]):
+        unknown = set(fields) - set(self.columns)
+        if unknown:
+            raise ValueError(f"Unknown columns: {sorted(unknown)}")
+        if isinstance(fields.get("altLabels"), list):
+            fields = {**fields, "altLabels": json.dumps(fields["altLabels"])}
+
+        record = dict(zip(self.columns, self.records[wd_id])) if wd_id in self.records else {}
+        record.update(fields, wd_id=wd_id)
+        if wd_id in self.records:
+            self._unindex_school(wd_id)
+        self.records[wd_id] = tuple(record.get(column) for column in self.columns)
+        self._index_school(
+            wd_id,
+            school_keys(record["name"], record.get("altLabels")),
+            school_categories(record.get("instance of") or ""),
+        )
+        self._dataframe = None
+        self.delta.append({"op": "set", "wd_id": wd_id, "fields": fields})
+        self._version = None
+
+    @staticmethod
+    def _add_id(id_map: dict[str, list[str]], key: str, wd_id: str):
+        ids = id_map.setdefault(key, [])
+        if wd_id not in ids:
+            ids.append(wd_id)
+
+    @staticmethod
+    def _remove_id(id_map: dict[str, list[str]], key: str, wd_id: str):
+        ids = id_map.get(key)
+        if ids is not None and wd_id in ids:
+            ids.remove(wd_id)
+            if not ids:
+                del id_map[key]
+
+    def _index_school(self, wd_id: str, keys: list[str], categories: list[str]):
+        for key in dict.fromkeys(keys):
+            if key not in self.name_positions:
+                position = len(self.names)
+                self.names.append(key)
+                self.name_positions[key] = position
+                for category in self.category_masks:
+                    self.category_masks[category] = np.append(self.category_masks[category], False)
+                self.prefilter.add(position, key)
+                self.features.add(key)
+
+            self._add_id(self.string_id_map, key, wd_id)
+            for category in categories:
+                self._add_id(self.category_maps[category], key, wd_id)
+                self.category_masks[category][self.name_positions[key]] = True
+            for form in short_forms(key):
+                self._add_id(self.short_form_map, form, wd_id)
+            self._keys_by_id[wd_id].add(key)
+
+    def _unindex_school(self, wd_id: str):
+        for key in self._keys_by_id.pop(wd_id, set()):
+            self._remove_id(self.string_id_map, key, wd_id)
+            for category, category_map in self.category_maps.items():
+                self._remove_id(category_map, key, wd_id)
+                if key not in category_map:
+                    self.category_masks[category][self.name_positions[key]] = False
+            for form in short_forms(key):
+                self._remove_id(self.short_form_map, form, wd_id)
+
+            if key not in self.string_id_map:
+                # Leave the name in place in `names`, but out of everything that finds names
+                self.prefilter.remove(self.name_positions.pop(key), key)
+
+    @classmethod
+    def build(cls, csv_path: str = SCHOOLS_CSV_PATH) -> "SchoolsIndex":
+        """
+        Build the index from a schools CSV.
+
+        Parameters
+        ----------
+            csv_path (str): The path to schools.csv.
+
+        Returns
+        -------
+            SchoolsIndex: The index.
+        """
+        from donoratlas.schools.match_school import read_csv
+
+        df_schools, string_id_map, *category_dicts = read_csv(csv_path)
+        category_maps = {
+            category: dict(category_dict) for category, category_dict in zip(CATEGORIES, category_dicts)
+        }
+
+        # Keep the first row for each id, as the matcher always has
+        records: dict[str, tuple] = {}
+        for row in df_schools.itertuples(index=False, name=None):
+            records.setdefault(row[df_schools.columns.get_loc("wd_id")], row)
+
+        stat = os.stat(csv_path)
+        return cls(
+            source_hash=file_hash(csv_path),
+            source_stat=(stat.st_size, stat.st_mtime_ns),
+            string_id_map=string_id_map,
+            category_maps=category_maps,
+            columns=list(df_schools.columns),
+            records=records,
+        )
+
+    def save(self, index_path: str = SCHOOLS_INDEX_PATH):
+        """
+        Write the index to a file.
+
+        Parameters
+        ----------
+            index_path (str): The path to write to.
+        """
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump((INDEX_FORMAT_VERSION, self), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path: str = SCHOOLS_INDEX_PATH) -> Optional["SchoolsIndex"]:
+        """
+        Read an index from a file.
+
+        Parameters
+        ----------
+            index_path (str): The path to read from.
+
+        Returns
+        -------
+            Optional[SchoolsIndex]: The index, or None if there is no index file or it has an outdated format.
+        """
+        try:
+            with open(index_path, "rb") as file:
+                format_version, index = pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            return None
+        return index if format_version == INDEX_FORMAT_VERSION else None
+
+
+def load_index(
+    csv_path: str = SCHOOLS_CSV_PATH,
+    index_path: str = SCHOOLS_INDEX_PATH,
+    delta_path: str = SCHOOLS_DELTA_PATH,
+) -> SchoolsIndex:
+    """
+    Load the schools index, rebuilding (and saving) it if the CSV has changed since it was built, and apply the
+    saved changes to it.
+
+    Parameters
+    ----------
+        csv_path (str): The path to schools.csv.
+        index_path (str): The path to the index file.
+        delta_path (str): The path to the changes saved by `SchoolsIndex.save_delta`, if any.
+
+    Returns
+    -------
+        SchoolsIndex: The index.
+    """
+    index = SchoolsIndex.load(index_path)
+    if index is not None:
+        stat = os.stat(csv_path)
+        source_stat = (stat.st_size, stat.st_mtime_ns)
+        if index.source_stat != source_stat:
+            if index.source_hash == file_hash(csv_path):
+                # Only touched (e.g. by a checkout), so record the new stat to skip hashing it next time
+                index.source_stat = source_stat
+                try:
+                    index.save(index_path)
+                except OSError:
+                    # Read-only installs just hash the CSV again in each process
+                    pass
+            else:
+                index = None
+
+    if index is None:
+        index = SchoolsIndex.build(csv_path)
+        try:
+            index.save(index_path)
+        except OSError:
+            # Read-only installs can still match, they just rebuild the index in each process
+            pass
+
+    # An index saved after being changed already has its changes
+    if not index.delta and os.path.exists(delta_path):
+        with open(delta_path, encoding="utf-8") as file:
+            index.apply_delta(json.load(file))
+    return index
+
+
+_index: Optional[SchoolsIndex] = None
+
+
+def get_index() -> SchoolsIndex:
+    """
+    Get the schools index, loading it on first use.
+    """
+    global _index
+    if _index is None:
+        _index = load_index()
+    return _index
+
+
+if __name__ == "__main__":
+    # Build through the importable module (not __main__) so the pickled index can be loaded elsewhere
+    from donoratlas.schools import index as schools_index
+
+    parser = argparse.ArgumentParser(description="Compile schools.csv into the schools index.")
+    parser.add_argument("--csv", default=SCHOOLS_CSV_PATH, help="The schools CSV to compile.")
+    parser.add_argument("--output", default=SCHOOLS_INDEX_PATH, help="Where to write the index.")
+    args = parser.parse_args()
+
+    index = schools_index.SchoolsIndex.build(args.csv)
+    index.save(args.output)
+    print(f"Wrote index {index.version} with {len(index.records):,} schools to {args.output}")
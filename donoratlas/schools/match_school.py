@@ -1,14 +1,89 @@
 import json
-import os
+import logging
 import re
 import time
 from collections import defaultdict
-from typing import Any, List, Optional, Tuple, TypedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypedDict
 
+import numpy as np
 import pandas as pd
 from pydantic import BaseModel
 from rapidfuzz import fuzz, process
 
+from donoratlas.schools.cache import MatchCache
+from donoratlas.schools.index import (
+    CATEGORIES,
+    PREFILTER_LIMIT,
+    SCHOOLS_CSV_PATH,
+    SCORING_IGNORE_WORDS,
+    SchoolsIndex,
+    get_index,
+    normalize_text,
+    school_categories,
+    school_keys,
+)
+
+logger = logging.getLogger(__name__)
+
+# Queries taking longer than this many seconds are logged at INFO level
+SLOW_QUERY_SECONDS = 1.0
+
+
+class MatchStats(BaseModel):
+    """
+    Instrumentation for a single call to match_string_to_school_id.
+
+    Attributes
+    ----------
+        query (str): The preprocessed query.
+        cache_hit (bool): Whether the result came from a MatchCache.
+        candidate_counts (dict[str, int]): The number of candidates found for each string matched against (the
+            query, then the fragments it was split into, if the direct match failed).
+        split_strategy (Optional[str]): How split_query split the query, if the direct match failed.
+        stage_seconds (dict[str, float]): The time spent in each stage of matching.
+        total_seconds (float): The total time taken.
+        cut_short (bool): Whether matching ran out of budget and returned the best answer found so far.
+    """
+
+    query: str = ""
+    cache_hit: bool = False
+    candidate_counts: Dict[str, int] = {}
+    split_strategy: Optional[str] = None
+    stage_seconds: Dict[str, float] = {}
+    total_seconds: float = 0.0
+    cut_short: bool = False
+
+
+class _Budget:
+    """
+    A time and work budget for matching a query, checked between stages.
+    """
+
+    def __init__(
+        self, stats: MatchStats, deadline: Optional[float] = None, max_candidates: Optional[int] = None
+    ):
+        self.stats = stats
+        self.end = None if deadline is None else time.perf_counter() + deadline
+        self.max_candidates = max_candidates
+
+    def exhausted(self) -> bool:
+        if (self.end is not None and time.perf_counter() > self.end) or (
+            self.max_candidates is not None
+            and sum(self.stats.candidate_counts.values()) >= self.max_candidates
+        ):
+            self.stats.cut_short = True
+        return self.stats.cut_short
+
+
+@contextmanager
+def _timed(stats: MatchStats, stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.stage_seconds[stage] = stats.stage_seconds.get(stage, 0.0) + time.perf_counter() - start
+
 
 class ProcessedWikidata(TypedDict):
     name: str
@@ -18,10 +93,6 @@ class ProcessedWikidata(TypedDict):
     instances: List[str]
 
 
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-SCHOOLS_CSV_PATH = os.path.join(BASE_DIR, "static", "schools.csv")
-
-
 def read_csv(csv_file_path: str):
     # read csv into dataframe and dict
     df_schools = pd.read_csv(csv_file_path, dtype=str)
@@ -36,7 +107,6 @@ def read_csv(csv_file_path: str):
     eng_name_to_ids = defaultdict(list)
     high_school_ids = defaultdict(list)
 
-    categories = ["law", "business", "medical", "engineer", "high school"]
     category_dicts = [
         law_name_to_ids,
         business_name_to_ids,
@@ -48,129 +118,361 @@ def read_csv(csv_file_path: str):
     for _, row in df_schools.iterrows():
         wd_id = row["wd_id"]
         # Normalize name and nicknames for consistency
-        name = row["name"].encode("utf-8").decode("unicode_escape").strip().lower()
-
-        if pd.notna(row["altLabels"]):  # Check if 'nicknames' is not NaN
-            nicknames = [
-                nickname.encode("utf-8").decode("unicode_escape").strip().strip("'").strip('"').lower()
-                for nickname in json.loads(row["altLabels"])
-                if nickname.strip()
-            ]
-        else:
-            nicknames = []
+        keys = school_keys(row["name"], row["altLabels"])
 
         # Add wd_id to the main name and nicknames
-        name_to_ids[name].append(wd_id)
-        for nickname in nicknames:
-            name_to_ids[nickname].append(wd_id)
-        for i, category in enumerate(categories):
-            if category in row["instance of"]:
-                category_dicts[i][name].append(wd_id)
-                for nickname in nicknames:
-                    category_dicts[i][nickname].append(wd_id)
+        for key in keys:
+            name_to_ids[key].append(wd_id)
+        for category in school_categories(row["instance of"]):
+            for key in keys:
+                category_dicts[CATEGORIES.index(category)][key].append(wd_id)
 
     # Ensure unique wd_ids for each name/nickname
     string_id_map = {key: list(set(value)) for key, value in name_to_ids.items()}
-    for i, dict in enumerate(category_dicts):
-        globals()[f"string_id_map_{categories[i]}"] = {key: list(set(value)) for key, value in dict.items()}
-    return df_schools, string_id_map, *category_dicts
+    category_maps = [
+        {key: list(set(value)) for key, value in category_dict.items()} for category_dict in category_dicts
+    ]
+    return df_schools, string_id_map, *category_maps
+
+
+# The maps that used to be built at import are now loaded lazily from the schools index
+_INDEX_ATTRIBUTES = {
+    "STRING_ID_MAP": lambda index: index.string_id_map,
+    "LAW_NAME_TO_IDS": lambda index: index.category_maps["law"],
+    "BUSINESS_NAME_TO_IDS": lambda index: index.category_maps["business"],
+    "MED_NAME_TO_IDS": lambda index: index.category_maps["medical"],
+    "ENG_NAME_TO_IDS": lambda index: index.category_maps["engineer"],
+    "HIGH_SCHOOL_IDS": lambda index: index.category_maps["high school"],
+    "DF_SCHOOLS": lambda index: index.dataframe,
+}
+
+
+def __getattr__(name: str):
+    if name in _INDEX_ATTRIBUTES:
+        return _INDEX_ATTRIBUTES[name](get_index())
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# The keywords in a query which restrict the search to a category of schools
+CATEGORY_KEYWORDS = {
+    "medical": [" medical", "med"],
+    "law": [" law"],
+    "engineer": [" engineering"],
+    "business": [" business"],
+    "high school": [" high school"],
+}
+
+
+class SchoolMatcher:
+    """
+    Fuzzy search over the school names in the index, restricted to the categories a query mentions.
+
+    Attributes
+    ----------
+        index (SchoolsIndex): The index searched.
+        version (str): The version of the index the matcher was built for.
+        choices (dict[Optional[str], list[str]]): The names in each category (and all names, under None).
+    """
+
+    def __init__(self, index: SchoolsIndex):
+        self.index = index
+        self.version = index.version
+        self.choices: dict[Optional[str], list[str]] = {None: list(index.string_id_map)}
+        for category, category_map in index.category_maps.items():
+            self.choices[category] = list(category_map)
+
+    @staticmethod
+    def categories(entity_str: str) -> tuple[str, ...]:
+        """
+        Get the categories of schools an entity string mentions (e.g. "law" for "Harvard Law School").
+        """
+        entity_str = entity_str.casefold()
+        categories = tuple(
+            category
+            for category, keywords in CATEGORY_KEYWORDS.items()
+            if any(keyword in entity_str for keyword in keywords)
+        )
+        if categories:
+            logger.debug("searching %s ids", ", ".join(categories))
+        return categories
+
+    def _mask(self, categories: tuple[str, ...]) -> Optional[np.ndarray]:
+        if not categories:
+            return None
+        if len(categories) == 1:
+            return self.index.category_masks[categories[0]]
+        return np.logical_or.reduce([self.index.category_masks[category] for category in categories])
+
+    def _choices(self, categories: tuple[str, ...]) -> list[str]:
+        if len(categories) <= 1:
+            return self.choices[categories[0] if categories else None]
+        # Several categories are searched together, in index order
+        return [self.index.names[i] for i in np.flatnonzero(self._mask(categories))]
+
+    def exact(self, query: str) -> Optional[List[Tuple[str, float, List[str]]]]:
+        """
+        Look a casefolded query up as an exact name, nickname, acronym or short form ("ucla", "suny broome").
+
+        Returns the single candidate it resolves to (with a score of 100), or None if it isn't one. Several ids
+        under one short form are left to `choose_best_id`.
+        """
+        ids = self.index.string_id_map.get(query)
+        if ids is None:
+            ids = self.index.short_form_map.get(query)
+        if ids is None:
+            return None
+        logger.debug("exact match for %s: %s", query, ids)
+        return [(query, 100.0, ids)]
+
+    def search(
+        self, entity_str: str, use_prefilter=False, prefilter_limit=PREFILTER_LIMIT
+    ) -> List[Tuple[str, float, List[str]]]:
+        """
+        Find the names matching an entity string. See `fetch_csv_properties`.
+        """
+        categories = self.categories(entity_str)
+        query = entity_str.casefold().strip()
+        # Category searches are left to fuzzy matching, which keeps to names in the category
+        exact = None if categories else self.exact(query)
+        if exact is not None:
+            return exact
+        candidate_idx = (
+            self.index.prefilter.candidates(query, prefilter_limit, self._mask(categories))
+            if use_prefilter
+            else None
+        )
+        choices = (
+            self._choices(categories)
+            if candidate_idx is None
+            else [self.index.names[i] for i in candidate_idx]
+        )
+        matches = process.extract(query, choices, scorer=fuzz.WRatio, limit=50, score_cutoff=70)
+        return self._to_candidates(matches)
+
+    def search_many(
+        self,
+        entity_strs: List[str],
+        workers: Optional[int] = None,
+        use_prefilter=False,
+        prefilter_limit=PREFILTER_LIMIT,
+        batch_size: int = 64,
+    ) -> List[List[Tuple[str, float, List[str]]]]:
+        """
+        Find the names matching many entity strings. See `fetch_csv_properties_many`.
+        """
+        results: dict[str, List[Tuple[str, float, List[str]]]] = {}
+        # Queries are scored in batches against a shared list of choices: every name in their categories when
+        # scanning in full, or else exactly the names the prefilter picked for them
+        full_scans: dict[tuple[str, ...], list[tuple[str, str]]] = defaultdict(list)
+        prefiltered: dict[bytes, list[tuple[str, str]]] = defaultdict(list)
+        candidate_sets: dict[bytes, np.ndarray] = {}
+        for entity_str in dict.fromkeys(entity_strs):
+            logger.debug("fetching csv entries for %s", entity_str)
+            categories = self.categories(entity_str)
+            query = entity_str.casefold().strip()
+            exact = None if categories else self.exact(query)
+            if exact is not None:
+                results[entity_str] = exact
+                continue
+            candidate_idx = (
+                self.index.prefilter.candidates(query, prefilter_limit, self._mask(categories))
+                if use_prefilter
+                else None
+            )
+            if candidate_idx is None:
+                # Not prefiltering (or too short to prefilter)
+                full_scans[categories].append((entity_str, query))
+            else:
+                key = candidate_idx.tobytes()
+                candidate_sets[key] = candidate_idx
+                prefiltered[key].append((entity_str, query))
+
+        names = self.index.names
+        batches = [(self._choices(categories), group) for categories, group in full_scans.items()]
+        batches += [([names[i] for i in candidate_sets[key]], group) for key, group in prefiltered.items()]
+        for choices, group in batches:
+            for start in range(0, len(group), batch_size):
+                batch = group[start : start + batch_size]
+                scores = process.cdist(
+                    [query for _, query in batch],
+                    choices,
+                    scorer=fuzz.WRatio,
+                    score_cutoff=70,
+                    dtype=np.float64,
+                    workers=-1 if workers is None else workers,
+                )
+                for (entity_str, _), row in zip(batch, scores):
+                    results[entity_str] = self._best_matches(row, choices)
+
+        return [results[entity_str] for entity_str in entity_strs]
+
+    def _best_matches(self, scores: np.ndarray, choices: list[str]) -> List[Tuple[str, float, List[str]]]:
+        # Same as process.extract: at most 50 scores of 70 or more, best first, ties in choice order
+        matched = np.flatnonzero(scores >= 70)
+        order = matched[np.lexsort((matched, -scores[matched]))][:50]
+        return self._to_candidates([(choices[i], float(scores[i]), i) for i in order])
+
+    def _to_candidates(self, matches: List[Tuple[str, float, Any]]) -> List[Tuple[str, float, List[str]]]:
+        string_id_map = self.index.string_id_map
+        if matches and matches[0][1] == 100:
+            return [
+                (matched_key, score, string_id_map[matched_key])
+                for matched_key, score, _ in matches
+                if score == 100
+            ]
+        return [(matched_key, score, string_id_map[matched_key]) for matched_key, score, _ in matches]
+
 
+_matcher: Optional[SchoolMatcher] = None
 
-(
-    DF_SCHOOLS,
-    STRING_ID_MAP,
-    LAW_NAME_TO_IDS,
-    BUSINESS_NAME_TO_IDS,
-    MED_NAME_TO_IDS,
-    ENG_NAME_TO_IDS,
-    HIGH_SCHOOL_IDS,
-) = read_csv(SCHOOLS_CSV_PATH)
+
+def get_matcher() -> SchoolMatcher:
+    """
+    Get the matcher for the current schools index, building it on first use (and whenever the index changes).
+    """
+    global _matcher
+    index = get_index()
+    if _matcher is None or _matcher.index is not index or _matcher.version != index.version:
+        _matcher = SchoolMatcher(index)
+    return _matcher
 
 
-def fetch_csv_properties(entity_str):
+def fetch_csv_properties(entity_str, use_prefilter=False, prefilter_limit=PREFILTER_LIMIT):
     """
     Fetch specified properties from a CSV based on keywords in the entity string.
 
+    Entity strings which are exactly a name, nickname, acronym or short form are looked up directly. Otherwise
+    keywords in the entity string restrict the search to categories of schools (see `CATEGORY_KEYWORDS`). When it
+    mentions several, their schools are searched together.
+
     Parameters:
         entity_str (str): The entity string (e.g., 'Harvard University').
-        csv_file_path (str): The path to the CSV file containing relevant institution data.
+        use_prefilter (bool): Whether to only fuzzy-score the names the token/trigram prefilter picks out,
+            instead of every name. This is faster on large indexes but can miss names (WRatio can score a name
+            highly without it sharing a token or trigram with the query), so check it with `prefilter_recall`.
+        prefilter_limit (int): The number of names the prefilter picks out.
 
     Returns:
-        pd.DataFrame: A DataFrame containing rows from the CSV that match the criteria.
-    """
-    print(f"fetching csv entries for {entity_str}")
-    str_to_search = STRING_ID_MAP
-    # Define the categories or keywords to search for in the entity string
-    if " medical" in entity_str.casefold() or "med" in entity_str.casefold():
-        str_to_search = MED_NAME_TO_IDS
-        print("searching med ids")
-    if " law" in entity_str.casefold():
-        str_to_search = LAW_NAME_TO_IDS
-        print("searching law ids")
-    if " engineering" in entity_str.casefold():
-        str_to_search = ENG_NAME_TO_IDS
-        print("searching eng ids")
-    if " business" in entity_str.casefold():
-        str_to_search = BUSINESS_NAME_TO_IDS
-        print("searching business ids")
-    if " high school" in entity_str.casefold():
-        str_to_search = HIGH_SCHOOL_IDS
-        print("searching high school ids")
-
-    entity_str = entity_str.casefold().strip()
-    matches = process.extract(entity_str, str_to_search.keys(), scorer=fuzz.WRatio, limit=50, score_cutoff=70)
-
-    if matches[0][1] == 100:
-        return [
-            (matched_key, score, STRING_ID_MAP[matched_key])
-            for matched_key, score, _ in matches
-            if score == 100
-        ]
-    return [
-        (matched_key, score, STRING_ID_MAP[matched_key]) for matched_key, score, _ in matches
-    ]
+        list[tuple[str, float, list[str]]]: The matched names, their scores, and the ids they refer to.
+    """
+    logger.debug("fetching csv entries for %s", entity_str)
+    return get_matcher().search(entity_str, use_prefilter=use_prefilter, prefilter_limit=prefilter_limit)
+
+
+def fetch_csv_properties_many(
+    entity_strs: List[str],
+    workers: Optional[int] = None,
+    use_prefilter=False,
+    prefilter_limit=PREFILTER_LIMIT,
+    batch_size: int = 64,
+) -> List[List[Tuple[str, float, List[str]]]]:
+    """
+    `fetch_csv_properties` for many entity strings at once.
+
+    Entity strings searching the same names (the same categories, or the same prefilter candidates) are scored
+    together in `process.cdist` calls, which run outside the GIL on `workers` threads.
+
+    Parameters:
+        entity_strs (list[str]): The entity strings.
+        workers (Optional[int]): The number of threads used for scoring. Defaults to all CPUs.
+        use_prefilter (bool): Whether to only fuzzy-score the names the prefilter picks out. See
+            `fetch_csv_properties`.
+        prefilter_limit (int): The number of names the prefilter picks out for each entity string.
+        batch_size (int): The number of entity strings scored in each call.
+
+    Returns:
+        list[list[tuple[str, float, list[str]]]]: The result of `fetch_csv_properties` for each entity string.
+    """
+    return get_matcher().search_many(
+        entity_strs,
+        workers=workers,
+        use_prefilter=use_prefilter,
+        prefilter_limit=prefilter_limit,
+        batch_size=batch_size,
+    )
+
+
+def prefilter_recall(queries: List[str], prefilter_limit=PREFILTER_LIMIT) -> dict[str, Any]:
+    """
+    Measure how many of the full-scan matches of `fetch_csv_properties` the prefilter keeps.
+
+    Parameters
+    ----------
+        queries : list[str]
+            The queries to check.
+        prefilter_limit : int
+            The number of names the prefilter picks out.
+
+    Returns
+    -------
+        dict[str, Any]
+            "recall": the fraction of full-scan matched names which are also matched with the prefilter,
+            "exact": the fraction of queries whose results are identical either way,
+            and "missed": a mapping from each query with lost matches to the names it lost.
+    """
+    n_full = 0
+    n_kept = 0
+    n_exact = 0
+    missed = {}
+    for query in queries:
+        full = fetch_csv_properties(query, use_prefilter=False)
+        prefiltered = fetch_csv_properties(query, use_prefilter=True, prefilter_limit=prefilter_limit)
+        lost = {name for name, _, _ in full} - {name for name, _, _ in prefiltered}
+        n_full += len(full)
+        n_kept += len(full) - len(lost)
+        n_exact += full == prefiltered
+        if lost:
+            missed[query] = sorted(lost)
+    return {
+        "recall": n_kept / n_full if n_full else 1.0,
+        "exact": n_exact / len(queries) if queries else 1.0,
+        "missed": missed,
+    }
 
 
 def retrieve_school_object(match_id: str):
-    match = DF_SCHOOLS[DF_SCHOOLS["wd_id"] == match_id]
+    index = get_index()
+    record = index.records.get(match_id)
 
-    if not match.empty:
-        return match.iloc[0].to_dict()
+    if record is not None:
+        return dict(zip(index.columns, record))
 
-    print(f"No match found for wd_id: {match_id}")
+    logger.debug("No match found for wd_id: %s", match_id)
     return None
 
 
-def custom_scoring_function(query, candidate, *, score_cutoff=None):
-    # print(query, candidate)
-    ignore_words = {
-        "school",
-        "college",
-        "university",
-        "state",
-        "law",
-        "business",
-        "medical",
-        "of",
-        "the",
-        "program",
-        "junior",
-        "senior",
-        "high",
-    }
+def retrieve_school_objects(match_ids: List[str]) -> List[Optional[dict]]:
+    """
+    Retrieve the rows of schools.csv for many school ids at once.
 
-    def normalize_text(s):
-        """Lowercase, strip, and remove parentheses."""
-        return re.sub(r"\(.*?\)", "", s).strip().lower()
+    Parameters
+    ----------
+        match_ids : list[str]
+            The school ids.
+
+    Returns
+    -------
+        list[Optional[dict]]
+            The row for each id as a dictionary, or None for unknown ids.
+    """
+    index = get_index()
+    columns = index.columns
+    records = index.records
+    return [
+        None if (record := records.get(match_id)) is None else dict(zip(columns, record))
+        for match_id in match_ids
+    ]
 
-    query = normalize_text(query.lower().strip())
-    candidate = normalize_text(candidate.lower().strip())
+
+def custom_scoring_function(query, candidate, *, score_cutoff=None):
+    query = normalize_text(query)
+    candidate = normalize_text(candidate)
 
     query_words = set(query.split())
     candidate_words = set(candidate.split())
 
-    important_query_words = query_words - ignore_words
-    important_candidate_words = candidate_words - ignore_words
+    important_query_words = query_words - SCORING_IGNORE_WORDS
+    important_candidate_words = candidate_words - SCORING_IGNORE_WORDS
 
     base_score = fuzz.token_sort_ratio(query, candidate)
     # print('base score:', base_score)
@@ -203,6 +505,95 @@ def custom_scoring_function(query, candidate, *, score_cutoff=None):
     return max(0, final_score)
 
 
+def custom_scores(query: str, candidates: List[str], score_cutoff: Optional[float] = None) -> np.ndarray:
+    """
+    `custom_scoring_function` of a query against many candidates at once.
+
+    The query is normalized once, and candidates in the schools index use its precomputed features.
+
+    Parameters
+    ----------
+        query : str
+            The query.
+        candidates : list[str]
+            The candidate names.
+        score_cutoff : Optional[float]
+            Scores below this are set to 0.
+
+    Returns
+    -------
+        np.ndarray
+            The score of each candidate.
+    """
+    index = get_index()
+    features = index.features
+    query = normalize_text(query)
+    query_words = set(query.split())
+    important_query_words = query_words - SCORING_IGNORE_WORDS
+
+    normalized, words, important_words, word_counts = [], [], [], []
+    for candidate in candidates:
+        position = index.name_positions.get(candidate)
+        if position is None:
+            candidate_normalized = normalize_text(candidate)
+            candidate_words = frozenset(candidate_normalized.split())
+            normalized.append(candidate_normalized)
+            words.append(candidate_words)
+            important_words.append(candidate_words - SCORING_IGNORE_WORDS)
+            word_counts.append(len(candidate_words))
+        else:
+            normalized.append(features.normalized[position])
+            words.append(features.words[position])
+            important_words.append(features.important_words[position])
+            word_counts.append(features.word_counts[position])
+
+    base_score = process.cdist([query], normalized, scorer=fuzz.token_sort_ratio, dtype=np.float64)[0]
+    coverage_score = (
+        np.array([len(query_words & candidate_words) for candidate_words in words], dtype=np.float64)
+        / len(query_words)
+        * 100
+        if query_words
+        else np.zeros(len(candidates))
+    )
+    important_coverage_score = (
+        np.array(
+            [len(important_query_words & candidate_words) for candidate_words in important_words],
+            dtype=np.float64,
+        )
+        / len(important_query_words)
+        * 100
+        if important_query_words
+        else np.zeros(len(candidates))
+    )
+    length_difference_penalty = np.abs(len(query_words) - np.array(word_counts, dtype=np.int64)) * 2
+    containment_bonus = np.array(
+        [20 if query in candidate or candidate in query else 0 for candidate in normalized], dtype=np.int64
+    )
+
+    final_score = (
+        (0.3 * base_score + 0.2 * coverage_score + 0.4 * important_coverage_score)
+        - length_difference_penalty
+        + containment_bonus
+    )
+    if score_cutoff is not None:
+        final_score[final_score < score_cutoff] = 0
+    return np.maximum(final_score, 0)
+
+
+def _extract_custom_scores(
+    query: str, candidates: List[str], score_cutoff: Optional[float] = None, limit: int = 5
+) -> List[Tuple[str, float, int]]:
+    """
+    `process.extract(query, candidates, scorer=custom_scoring_function, score_cutoff=score_cutoff)`, scoring
+    with `custom_scores`: the best `limit` candidates scoring at least `score_cutoff`, with ties in candidate order.
+    """
+    scores = custom_scores(query, candidates, score_cutoff)
+    order = np.argsort(-scores, kind="stable")
+    if score_cutoff is not None:
+        order = order[scores[order] >= score_cutoff]
+    return [(candidates[i], float(scores[i]), int(i)) for i in order[:limit]]
+
+
 def choose_best_id(match, score, ids):
     if len(ids) == 1:
         return ids[0]
@@ -211,8 +602,7 @@ def choose_best_id(match, score, ids):
     schools = []
     name_matches = []
     nickname_matches = []
-    for id in ids:
-        school = retrieve_school_object(id)
+    for school in retrieve_school_objects(ids):
         if school:
             school["score"] = score
             if match == school["name"].casefold():
@@ -231,7 +621,7 @@ def find_best_match(
     query: str, data: List[Tuple[str, float, List[str]]], verbose=False, accept_substring_score=False
 ):
     if verbose:
-        print(f"finding best match for {query} from {data}")
+        logger.debug("finding best match for %s from %s", query, data)
     if len(data) == 1:
         if len(data[0][2]) == 1 and data[0][1] > 95:
             return data[0][2][0], data[0][1]
@@ -241,57 +631,51 @@ def find_best_match(
     if len(max_scores) == 1:
         return max_scores[0][2][0], max_scores[0][1]
     # If all strings refer to the same place, return
-    all_match = True
-    while all_match:
-        for match in data:
-            for id in match[2]:
-                if id != data[0][2][0]:
-                    all_match = False
+    all_match = all(id == data[0][2][0] for match in data for id in match[2])
     if all_match:
-        print("all ids the same. returning.")
-        return choose_best_id(*data[0])
+        logger.debug("all ids the same. returning.")
+        return choose_best_id(*data[0]), data[0][1]
 
+    string_id_map = get_index().string_id_map
     strings_to_match = [datum[0] for datum in data]
-    new_scores_cutoff = process.extract(
-        query, strings_to_match, scorer=custom_scoring_function, score_cutoff=70
-    )
+    new_scores_cutoff = _extract_custom_scores(query, strings_to_match, score_cutoff=70)
 
     if new_scores_cutoff:
         threshold = 0
         new_scores_filtered = [
-            (matched_key, score, STRING_ID_MAP[matched_key])
+            (matched_key, score, string_id_map[matched_key])
             for matched_key, score, _ in new_scores_cutoff
             if score >= threshold
         ]
 
-        print("new scores", new_scores_filtered)
+        logger.debug("new scores %s", new_scores_filtered)
         max_score = new_scores_filtered[0][1]
-        print("max scores:", max_score)
+        logger.debug("max scores: %s", max_score)
         max_scores = [
-            (matched_key, score, STRING_ID_MAP[matched_key])
+            (matched_key, score, string_id_map[matched_key])
             for matched_key, score, _ in new_scores_filtered
             if score >= max_score
         ]
 
         if verbose:
-            print(max_scores)
+            logger.debug("%s", max_scores)
 
         return choose_best_id(*max_scores[0]), max_score
     elif accept_substring_score:
         scores = []
-        new_scores = process.extract(query, strings_to_match, scorer=custom_scoring_function)
+        new_scores = _extract_custom_scores(query, strings_to_match)
         for candidate in new_scores:
-            print(query, candidate[0])
+            logger.debug("%s %s", query, candidate[0])
             if query.casefold() in candidate[0].casefold():
                 scores.append(candidate)
             elif candidate[0].casefold() in query.casefold():
                 scores.append(candidate)
             else:
-                print("did not add")
-        scores = [(matched_key, score, STRING_ID_MAP[matched_key]) for matched_key, score, _ in scores]
-        print("substring scores", scores)
+                logger.debug("did not add")
+        scores = [(matched_key, score, string_id_map[matched_key]) for matched_key, score, _ in scores]
+        logger.debug("substring scores %s", scores)
         max_score = max(scores, key=lambda x: x[1])
-        print("max score", max_score)
+        logger.debug("max score %s", max_score)
         return max_score[2][0], max_score[1]
 
     else:
@@ -331,33 +715,56 @@ def split_query(query: str):
         list[str]
             The split query.
     """
-    print("splitting query")
+    return split_query_with_strategy(query)[0]
+
+
+def split_query_with_strategy(query: str):
+    """
+    Split the query into a list of strings, and report how it was split.
+
+    Parameters
+    ----------
+        query : str
+            The query to split.
+
+    Returns
+    -------
+        tuple[Optional[list[str]], Optional[str]]
+            The split query (as returned by split_query), and which delimiter it was split on ("from/at", "(",
+            ",", "-" or ":"), None if it could not be split, or "error" if splitting raised.
+    """
+    logger.debug("splitting query")
     try:
         # Use re.split to split on the specified words
         new_query = re.split(r"\b(from|at)\b", query)
-        print('splitting on "from", "at"', new_query)
+        logger.debug('splitting on "from", "at" %s', new_query)
         did_split_on_from_at = new_query[0] != query
+        strategy = "from/at"
 
         if new_query[0] == query:
-            print("splitting query on (")
+            logger.debug("splitting query on (")
             new_query = query.split("(")
             new_query = [query.strip().strip("(").strip(")") for query in new_query]
+            strategy = "("
 
         if new_query[0] == query:
-            print("splitting query on ,")
+            logger.debug("splitting query on ,")
             new_query = query.split(",")
+            strategy = ","
 
         if new_query[0] == query:
-            print("splitting query on -")
+            logger.debug("splitting query on -")
             new_query = query.split("-")
+            strategy = "-"
 
         if new_query[0] == query:
-            print("splitting query on :")
+            logger.debug("splitting query on :")
             new_query = query.split(":")
+            strategy = ":"
 
         if new_query[0] == query:
-            print("returning original query")
-            return None
+            logger.debug("returning original query")
+            return None, None
 
         words_to_check = ["college", "university", "school", "institute", "academy"]
         to_return = []
@@ -374,80 +781,221 @@ def split_query(query: str):
         if to_return == [] and did_split_on_from_at:
             first_split_index = [i for i, w in enumerate(new_query) if w in ["from", "at"]][0]
             if first_split_index is not None:
-                return new_query[first_split_index + 1 :]
-            return new_query[-1]
-        print("returning new_query", to_return)
-        return to_return
+                return new_query[first_split_index + 1 :], strategy
+            return new_query[-1], strategy
+        logger.debug("returning new_query %s", to_return)
+        return to_return, strategy
         # print('new query:', new_query)
         # return new_query
     except:
-        print("Error splitting query. Returning original")
-        return None
+        logger.debug("Error splitting query. Returning original")
+        return None, "error"
 
 
 # Main function to resolve entity
-def match_string_to_school_id(query, verbose=False):
+def match_string_to_school_id(
+    query,
+    verbose=False,
+    cache: Optional[MatchCache] = None,
+    stats: Optional[MatchStats] = None,
+    slow_query_seconds: Optional[float] = None,
+    deadline: Optional[float] = None,
+    max_candidates: Optional[int] = None,
+):
     """
     This is the function that returns the id of the school in question.
     If multiple schools exactly match, returns an array of ids.
     If no schools match well enough, returns None.
+    If a MatchCache is given, results are looked up in and saved to it.
+    If a MatchStats is given, it is filled in with instrumentation for the query.
+    Queries slower than slow_query_seconds (SLOW_QUERY_SECONDS by default) are logged at INFO level.
+    Matching stops early once it has taken deadline seconds or found max_candidates candidates in total (checked
+    between stages), returning the best answer found so far and setting stats.cut_short. Cut short results are
+    not cached.
+    """
+    start = time.perf_counter()
+    stats = MatchStats() if stats is None else stats
+    budget = _Budget(stats, deadline, max_candidates)
+    with _timed(stats, "preprocess"):
+        query = preprocess_query(query)
+    stats.query = query
+
+    hit = False
+    if cache is not None:
+        with _timed(stats, "cache"):
+            hit, result = cache.get(query)
+        stats.cache_hit = hit
+    if not hit:
+        result = _match_string_to_school_id(query, fetch_csv_properties_many, stats, budget)
+        if cache is not None and not stats.cut_short:
+            with _timed(stats, "cache"):
+                cache.set(query, result)
+
+    stats.total_seconds = time.perf_counter() - start
+    _log_if_slow(stats, slow_query_seconds)
+    return result
+
+
+def _log_if_slow(stats: MatchStats, slow_query_seconds: Optional[float]):
+    threshold = SLOW_QUERY_SECONDS if slow_query_seconds is None else slow_query_seconds
+    if stats.total_seconds > threshold:
+        logger.info(
+            "slow school match (%.3fs > %.3fs): %s", stats.total_seconds, threshold, stats.model_dump()
+        )
+
+
+def _match_string_to_school_id(
+    query,
+    fetch_many: Callable[[List[str]], List[List[Tuple[str, float, List[str]]]]],
+    stats: Optional[MatchStats] = None,
+    budget: Optional[_Budget] = None,
+):
+    # query has already been through preprocess_query
+    stats = MatchStats() if stats is None else stats
+    budget = _Budget(stats) if budget is None else budget
+
+    logger.debug("%s", query)
+    with _timed(stats, "fetch"):
+        (candidates,) = fetch_many([query.casefold()])
+    # Ranking candidates already found is cheap, so it's done even when the budget has run out
+    best_match = _match_direct(query, candidates, stats)
+    if best_match is not None or budget.exhausted():
+        return best_match
+
+    with _timed(stats, "split"):
+        fragments, stats.split_strategy = split_query_with_strategy(query)
+    fragments = _fragments(fragments)
+    # The fragments are all searched for in one batched call
+    fragment_strs = list(dict.fromkeys(fragment.casefold() for fragment in fragments))
+    with _timed(stats, "fetch"):
+        fetched = dict(zip(fragment_strs, fetch_many(fragment_strs))) if fragment_strs else {}
+    return _match_fragments(fragments, fetched, stats, budget)
+
+
+def _match_direct(query, candidates: List[Tuple[str, float, List[str]]], stats: MatchStats):
+    """
+    The best match among the candidates found for the whole query, or None if there isn't a good enough one.
     """
-    query = preprocess_query(query)
-    print(query)
-    candidates = fetch_csv_properties(query.casefold())
-    print("candidates", len(candidates), candidates)
-    if candidates:
+    stats.candidate_counts[query.casefold()] = len(candidates)
+    logger.debug("candidates %d %s", len(candidates), candidates)
+    if not candidates:
+        return None
+    with _timed(stats, "rank"):
         best_match = find_best_match(query, candidates, verbose=True)
-        print("best_match", best_match)
-        if best_match[0]:
-            return best_match[0]
-        else:
-            try:
-                queries = split_query(query)
-                if not queries:
-                    return None
-                best_matches = []
-                for query in queries:
-                    candidates = fetch_csv_properties(query.casefold())
-                    if candidates:
-                        best_match, max_score = find_best_match(
-                            query, candidates, verbose=True, accept_substring_score=True
-                        )
-                        if best_match:
-                            best_matches.append((best_match, max_score))
-                    else:
-                        print("no candidates found (line 408)")
-                print("best matches", best_matches)
-                if best_matches == []:
-                    return None
-                elif len(best_matches) == 1:
-                    return best_matches[0][0]
-                else:
-                    max_tuple = max(best_matches, key=lambda x: x[1])
-                    return max_tuple[0]
-            except:
-                return None
-        # if best_match:
-        #     match = retrieve_school_object(best_match)
-        #     return match
-    try:
-        queries = split_query(query)
-        if not queries:
-            return None
-        candidates = [fetch_csv_properties(query.casefold()) for query in queries][0]
-        if candidates:
-            best_match, max_score = find_best_match(
-                queries[-1], candidates, verbose=True, accept_substring_score=True
-            )
-            if best_match:
-                return best_match
-            else:
-                return None
+    logger.debug("best_match %s", best_match)
+    return best_match[0] or None
+
+
+def _match_fragments(
+    fragments: List[str],
+    fetched: Dict[str, List[Tuple[str, float, List[str]]]],
+    stats: MatchStats,
+    budget: _Budget,
+):
+    """
+    The best match for any of the fragments of a query, given the candidates found for each (casefolded) fragment.
+    """
+    best_matches = []
+    for fragment in fragments:
+        if budget.exhausted():
+            # Settle for the best of the fragments matched so far
+            break
+        candidates = fetched[fragment.casefold()]
+        stats.candidate_counts[fragment.casefold()] = len(candidates)
+        if not candidates:
+            logger.debug("no candidates found for %s", fragment)
+            continue
+        try:
+            with _timed(stats, "rank"):
+                best_match, max_score = find_best_match(
+                    fragment, candidates, verbose=True, accept_substring_score=True
+                )
+        except Exception:
+            logger.debug("error matching %s", fragment, exc_info=True)
+            continue
+        if best_match:
+            best_matches.append((best_match, max_score))
+    logger.debug("best matches %s", best_matches)
+    if best_matches == []:
+        return None
+    # Matches without a score are the least confident
+    return max(best_matches, key=lambda x: x[1] or 0)[0]
+
+
+def _fragments(split: Any) -> List[str]:
+    """
+    The fragments of a split_query result, which may be None, a list, or a single string.
+    """
+    if not split:
+        return []
+    if isinstance(split, str):
+        return [split]
+    return [fragment for fragment in split if fragment.strip()]
+
+
+def match_strings_to_school_ids(
+    queries: List[str], workers: Optional[int] = None, cache: Optional[MatchCache] = None
+) -> List[Any]:
+    """
+    Match many education strings to school ids at once, with the same results as `match_string_to_school_id`.
+
+    Queries are deduplicated and searched for in one batch with `fetch_csv_properties_many`. Only the queries with
+    no direct match are split, and all of their fragments are searched for in a second batch.
+
+    Parameters
+    ----------
+        queries : list[str]
+            The education strings.
+        workers : Optional[int]
+            The number of threads used for scoring. Defaults to all CPUs.
+        cache : Optional[MatchCache]
+            A cache to look results up in and save them to.
+
+    Returns
+    -------
+        list
+            The result of `match_string_to_school_id` for each query, in input order.
+    """
+    # Queries with the same preprocessed form have the same result, so each is only matched once
+    preprocessed = [preprocess_query(query) for query in queries]
+    results: dict[str, Any] = {}
+    unique_queries = []
+    for query in dict.fromkeys(preprocessed):
+        hit, result = (False, None) if cache is None else cache.get(query)
+        if hit:
+            results[query] = result
         else:
-            print("no candidates found (line 298)")
-    except:
-        return (None,)
-    return None
+            unique_queries.append(query)
+
+    # Search for every query as a whole first, and only split the ones with no direct match
+    query_strs = list(dict.fromkeys(query.casefold() for query in unique_queries))
+    direct = (
+        dict(zip(query_strs, fetch_csv_properties_many(query_strs, workers=workers))) if query_strs else {}
+    )
+    matched: dict[str, Any] = {}
+    unmatched: dict[str, List[str]] = {}
+    for query in unique_queries:
+        matched[query] = _match_direct(query, direct[query.casefold()], MatchStats())
+        if matched[query] is None:
+            unmatched[query] = _fragments(split_query(query))
+
+    # Then search for the fragments of all of those in a second batch
+    fragment_strs = list(
+        dict.fromkeys(fragment.casefold() for fragments in unmatched.values() for fragment in fragments)
+    )
+    fetched = (
+        dict(zip(fragment_strs, fetch_csv_properties_many(fragment_strs, workers=workers)))
+        if fragment_strs
+        else {}
+    )
+    for query, fragments in unmatched.items():
+        stats = MatchStats()
+        matched[query] = _match_fragments(fragments, fetched, stats, _Budget(stats))
+
+    if cache is not None:
+        cache.set_many(list(matched.items()))
+    results.update(matched)
+    return [results[preprocessed_query] for preprocessed_query in preprocessed]
 
 
 def test_random_schools():
@@ -508,6 +1056,8 @@ def test_random_schools():
 
 
 if __name__ == "__main__":
+    # Show the matcher's trace, as it used to be printed
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
     # print(test_random_schools())
     raw_input = input(">>> ")
 
@@ -0,0 +1,431 @@
+"""
+A long-lived local matching service.
+
+Loads the name lexicons and schools index once, and serves `parse_name`, `name_similarity`, name classification,
+address parsing, `address_similarity` and school matching as JSON over HTTP on localhost or a Unix socket.
+Concurrent requests to the same endpoint are coalesced into micro-batches for the batch engines.
+
+Run with `python -m donoratlas.service --port 8765` (or `--unix /tmp/donoratlas.sock`), then e.g.
+
+    curl -s localhost:8765/match_school -d '{"query": "Harvard Law School"}'
+    curl -s localhost:8765/metrics
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Any, Awaitable, Callable, Optional
+
+import numpy as np
+
+from donoratlas.addresses import ADDRESS_FIELDS, address_similarity, parse_addresses
+from donoratlas.names import NameTyper, name_similarity, parse_name
+from donoratlas.schools.index import get_index
+from donoratlas.schools.match_school import match_strings_to_school_ids
+
+logger = logging.getLogger(__name__)
+
+# The most requests to wait for before running a batch, and how long to wait for them
+MAX_BATCH_SIZE = 64
+MAX_BATCH_WAIT_SECONDS = 0.005
+
+# The largest request body accepted
+MAX_BODY_BYTES = 1 << 20
+
+# The number of recent requests that latency percentiles are computed over
+LATENCY_WINDOW = 10_000
+
+# The string fields each endpoint requires in its request body
+ENDPOINT_FIELDS = {
+    "/parse_name": ["name"],
+    "/classify_name": ["name"],
+    "/name_similarity": ["name1", "name2"],
+    "/parse_address": ["address"],
+    "/address_similarity": ["address1", "address2"],
+    "/match_school": ["query"],
+}
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into batches for a function which handles many items at once.
+
+    Requests are queued, and a single consumer takes up to `max_batch_size` of them at a time (waiting at most
+    `max_batch_wait` seconds for more to arrive after the first) and runs the batch function on them in an
+    executor, so the event loop keeps accepting requests meanwhile.
+
+    Attributes
+    ----------
+        name (str): The name of the endpoint, for metrics.
+        handle_batch (Callable[[list], list]): Maps a list of items to a list of results, in the same order.
+        max_batch_size (int): The most items in a batch.
+        max_batch_wait (float): How long to wait for a batch to fill up, in seconds.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handle_batch: Callable[[list], list],
+        executor: ThreadPoolExecutor,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_batch_wait: float = MAX_BATCH_WAIT_SECONDS,
+    ):
+        self.name = name
+        self.handle_batch = handle_batch
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+        self._executor = executor
+        self._queue: asyncio.Queue[tuple[Any, asyncio.Future, float]] = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Queue an item and wait for its result.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            batch_end = loop.time() + self.max_batch_wait
+            while len(batch) < self.max_batch_size:
+                timeout = batch_end - loop.time()
+                if timeout <= 0 and self._queue.empty():
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), max(timeout, 0)))
+                except asyncio.TimeoutError:
+                    break
+
+            items = [item for item, _, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self.handle_batch, items)
+            except Exception:
+                logger.exception("%s batch of %d failed, retrying items one at a time", self.name, len(items))
+                results = await loop.run_in_executor(self._executor, self._handle_items, items)
+
+            self.batches += 1
+            now = time.perf_counter()
+            for (_, future, queued_at), result in zip(batch, results):
+                self.requests += 1
+                self.latencies.append(now - queued_at)
+                if future.done():
+                    # The client went away
+                    continue
+                if isinstance(result, Exception):
+                    self.errors += 1
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _handle_items(self, items: list) -> list:
+        results = []
+        for item in items:
+            try:
+                results.append(self.handle_batch([item])[0])
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def metrics(self) -> dict[str, Any]:
+        """
+        Get the queue depth, request and batch counts, and latency percentiles (in milliseconds) of the endpoint.
+        """
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "queue_depth": self._queue.qsize(),
+            "requests": self.requests,
+            "errors": self.errors,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "latency_ms": (
+                {
+                    "p50": float(np.percentile(latencies, 50)),
+                    "p95": float(np.percentile(latencies, 95)),
+                    "p99": float(np.percentile(latencies, 99)),
+                    "max": float(latencies.max()),
+                }
+                if len(latencies)
+                else None
+            ),
+        }
+
+
+class BadRequest(Exception):
+    pass
+
+
+class MatchingService:
+    """
+    The endpoints of the service, each backed by a MicroBatcher.
+
+    POST endpoints take and return JSON objects:
+        /parse_name {"name"} -> {"name": PersonName}
+        /classify_name {"name"} -> {"is_individual": bool}
+        /name_similarity {"name1", "name2"} -> {"similarity": dict}
+        /parse_address {"address"} -> {"address": Address}
+        /address_similarity {"address1", "address2"} -> {"similarity": float}
+        /match_school {"query"} -> {"result": school id(s) or null}
+
+    GET /metrics returns the metrics of each endpoint, and GET /health returns {"status": "ok"}.
+    """
+
+    def __init__(self, max_batch_size: int = MAX_BATCH_SIZE, max_batch_wait: float = MAX_BATCH_WAIT_SECONDS):
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+        self.started_at = time.time()
+        self._name_typer: Optional[NameTyper] = None
+        # One thread, so batches for different endpoints never contend for the GIL or shared caches
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="donoratlas-batch")
+        self.batchers: dict[str, MicroBatcher] = {}
+
+    def load(self):
+        """
+        Load the name lexicons and schools index. libpostal is loaded on the first address libpostal is needed for.
+        """
+        self._name_typer = NameTyper()
+        get_index()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.load)
+        endpoints: dict[str, Callable[[list], list]] = {
+            "/parse_name": self._parse_names,
+            "/classify_name": self._classify_names,
+            "/name_similarity": self._name_similarities,
+            "/parse_address": self._parse_addresses,
+            "/address_similarity": self._address_similarities,
+            "/match_school": self._match_schools,
+        }
+        for path, handle_batch in endpoints.items():
+            batcher = MicroBatcher(
+                path.strip("/"), handle_batch, self._executor, self.max_batch_size, self.max_batch_wait
+            )
+            batcher.start()
+            self.batchers[path] = batcher
+
+    async def stop(self):
+        for batcher in self.batchers.values():
+            await batcher.stop()
+        self._executor.shutdown(wait=False)
+
+    # Batch handlers, which run in the executor. Requests have already been checked to have their fields.
+
+    def _parse_names(self, requests: list[dict]) -> list[dict]:
+        return [{"name": parse_name(request["name"]).model_dump()} for request in requests]
+
+    def _classify_names(self, requests: list[dict]) -> list[dict]:
+        names = [request["name"] for request in requests]
+        return [
+            {"is_individual": is_individual}
+            for is_individual in self._name_typer.classify(names, workers=1, chunk_size=len(names))
+        ]
+
+    def _name_similarities(self, requests: list[dict]) -> list[dict]:
+        return [{"similarity": name_similarity(request["name1"], request["name2"])} for request in requests]
+
+    def _parse_addresses(self, requests: list[dict]) -> list[dict]:
+        columns = parse_addresses([request["address"] for request in requests], workers=1)
+        return [
+            {"address": {field: columns[field][i] for field in ADDRESS_FIELDS}} for i in range(len(requests))
+        ]
+
+    def _address_similarities(self, requests: list[dict]) -> list[dict]:
+        return [
+            {"similarity": address_similarity(request["address1"], request["address2"])}
+            for request in requests
+        ]
+
+    def _match_schools(self, requests: list[dict]) -> list[dict]:
+        results = match_strings_to_school_ids([request["query"] for request in requests], workers=1)
+        return [{"result": result} for result in results]
+
+    async def handle(self, method: str, path: str, body: bytes) -> tuple[HTTPStatus, Any]:
+        """
+        Handle a request, returning the status and JSON response.
+        """
+        if method == "GET" and path == "/health":
+            return HTTPStatus.OK, {"status": "ok"}
+        if method == "GET" and path == "/metrics":
+            return HTTPStatus.OK, {
+                "uptime_seconds": time.time() - self.started_at,
+                "endpoints": {batcher.name: batcher.metrics() for batcher in self.batchers.values()},
+            }
+
+        batcher = self.batchers.get(path)
+        if batcher is None:
+            return HTTPStatus.NOT_FOUND, {"error": f"unknown endpoint {path}"}
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "use POST"}
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST, {"error": "body must be JSON"}
+        if not isinstance(request, dict):
+            return HTTPStatus.BAD_REQUEST, {"error": "body must be a JSON object"}
+        for field in ENDPOINT_FIELDS[path]:
+            if not isinstance(request.get(field), str):
+                return HTTPStatus.BAD_REQUEST, {"error": f"{field!r} must be a string"}
+
+        try:
+            return HTTPStatus.OK, await batcher.submit(request)
+        except Exception as e:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": repr(e)}
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[tuple[str, str, dict[str, str], bytes]]:
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode("latin-1").split()
+    except ValueError:
+        raise BadRequest("malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get("content-length", 0) or 0)
+    if length > MAX_BODY_BYTES:
+        raise BadRequest("request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target.split("?", 1)[0], headers, body
+
+
+def _write_response(writer: asyncio.StreamWriter, status: HTTPStatus, payload: Any, keep_alive: bool):
+    body = json.dumps(payload).encode()
+    writer.write(
+        (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            "\r\n"
+        ).encode()
+        + body
+    )
+
+
+def make_connection_handler(
+    service: MatchingService,
+) -> Callable[[asyncio.StreamReader, asyncio.StreamWriter], Awaitable[None]]:
+    """
+    Make an asyncio stream handler serving HTTP/1.1 requests (with keep-alive) from the service.
+    """
+
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except (BadRequest, ValueError) as e:
+                    _write_response(writer, HTTPStatus.BAD_REQUEST, {"error": str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                status, payload = await service.handle(method, path, body)
+                _write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle_connection
+
+
+async def serve(
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    unix_path: Optional[str] = None,
+    max_batch_size: int = MAX_BATCH_SIZE,
+    max_batch_wait: float = MAX_BATCH_WAIT_SECONDS,
+):
+    """
+    Run the service until cancelled.
+
+    Parameters
+    ----------
+        host (str): The host to listen on.
+        port (int): The port to listen on.
+        unix_path (Optional[str]): If given, listen on this Unix socket instead of `host` and `port`.
+        max_batch_size (int): The most requests to an endpoint handled in one batch.
+        max_batch_wait (float): How long to wait for a batch to fill up, in seconds.
+    """
+    service = MatchingService(max_batch_size=max_batch_size, max_batch_wait=max_batch_wait)
+    await service.start()
+    handler = make_connection_handler(service)
+    if unix_path is not None:
+        server = await asyncio.start_unix_server(handler, path=unix_path)
+        logger.info("serving on unix socket %s", unix_path)
+    else:
+        server = await asyncio.start_server(handler, host=host, port=port)
+        logger.info("serving on http://%s:%d", host, port)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve DonorAtlas matching over local HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="The host to listen on.")
+    parser.add_argument("--port", type=int, default=8765, help="The port to listen on.")
+    parser.add_argument("--unix", default=None, help="Listen on this Unix socket instead of host and port.")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE, help="The largest batch size.")
+    parser.add_argument(
+        "--max-batch-wait-ms",
+        type=float,
+        default=MAX_BATCH_WAIT_SECONDS * 1000,
+        help="How long to wait for a batch to fill up.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    try:
+        asyncio.run(
+            serve(
+                host=args.host,
+                port=args.port,
+                unix_path=args.unix,
+                max_batch_size=args.max_batch_size,
+                max_batch_wait=args.max_batch_wait_ms / 1000,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
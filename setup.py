@@ -18,4 +18,5 @@ setup(
     install_requires=requirements,
     package_data={"donoratlas": ["static/**"]},
     include_package_data=True,
+    entry_points={"console_scripts": ["donoratlas=donoratlas.cli:main"]},
 )